@@ -1 +1 @@
-__all__ = ['api','oauth']
+__all__ = ['api','oauth','paging','pool','watcher','writebehind','bulk','transport','breaker','index','splitting','profiling','fanout','tokenstore']
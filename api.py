@@ -14,8 +14,15 @@ API_RELATIVE_URL = "external/v2/json/"  # Note trailing slash
 
 import os
 import oauth
+from transport import UrllibTransport
+from breaker import BreakerRegistry
+from splitting import Splitter
 import urllib, urllib2
 import sys
+import time
+import hmac
+import hashlib
+import binascii
 
 # Find a simplejson library somewhere!
 try:
@@ -27,9 +34,19 @@ except ImportError:
         "Please install the simplejson module or update to a Python version which includes json"
 
 class CodaServer(object):
-    def __init__(self, consumer_key, consumer_secret, server_url = CODA_SERVER_URL):
+    def __init__(self, consumer_key, consumer_secret, server_url = CODA_SERVER_URL, transport = None,
+                 timeout = None, breakers = None, splitter = None, profiler = None):
+        # timeout is in seconds, or a (connect, read) pair; None means no limit.
+        # The circuit breakers, the splitter for long UUID lists and the
+        # optional profiling.Profiler are shared by all the Coda objects
+        # from this server.
         self.server_url = server_url
         self.consumer = oauth.OAuthConsumer(consumer_key, consumer_secret)
+        self.transport = transport or UrllibTransport()
+        self.timeout = timeout
+        self.breakers = breakers or BreakerRegistry()
+        self.splitter = splitter or Splitter()
+        self.profiler = profiler
     
     def get_auth(self, callback=None):
         """
@@ -41,8 +58,7 @@ class CodaServer(object):
             http_url='%s/oauth/request_token/' % self.server_url,
             parameters={})
         oauth_request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), self.consumer, None)
-        response = urllib2.urlopen(oauth_request.to_url())
-        request_token_string = response.read()
+        request_token_string = self.transport.request(oauth_request.to_url(), None, self.timeout)
         request_token = oauth.OAuthToken.from_string(request_token_string)
 
         # Authentication request
@@ -67,8 +83,7 @@ class CodaServer(object):
         
         oauth_request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), self.consumer, request_token)
         try:
-            response = urllib2.urlopen(oauth_request.to_url())
-            access_token_string=response.read()
+            access_token_string = self.transport.request(oauth_request.to_url(), None, self.timeout)
         except urllib2.HTTPError, e:
             # print "CODA server said %s: %s" % (e.code, e.msg)
             raise CodaException("CODA server said %s: %s" % (e.code, e.msg))
@@ -76,7 +91,8 @@ class CodaServer(object):
             
     def get_coda(self, access_token):
         # Note this takes the string form of the access token
-        return Coda(access_token, "%s/%s" % (self.server_url,API_RELATIVE_URL), self.consumer)
+        return Coda(access_token, "%s/%s" % (self.server_url,API_RELATIVE_URL), self.consumer,
+                    self.transport, self.timeout, self.breakers, self.splitter, self.profiler)
         
 
 class CodaException(Exception):
@@ -84,17 +100,120 @@ class CodaException(Exception):
         self.msg = message
     def __str__(self):
         return repr(self.msg)
+
+class CodaCircuitOpen(CodaException):
+    """Raised without calling the server, because recent calls like this have been failing"""
         
+# The calls which return lists of records, with the field that identifies
+# each record and the parameter which selects a given set of them.
+# Only getSources(source_uuids=...) is documented; the others are assumed
+# to take a list of UUIDs in the same way.
+RECORD_METHODS = {
+    'getSources':  ('source_uuid',  'source_uuids'),
+    'getDisplays': ('display_uuid', 'display_uuids'),
+    'getUsers':    ('user_uuid',    'user_uuids'),
+}
+
+# The calls which take a list of UUIDs, and the parameter holding it.
+# Calls with long lists are split into several - see splitting.py
+LIST_PARAMS = {
+    'getSources':   'source_uuids',
+    'getDisplays':  'display_uuids',
+    'getUsers':     'user_uuids',
+    'assignSource': 'display_uuids',
+}
+
+# Large parameter values are encoded and escaped in pieces of about this size
+CHUNK_SIZE = 65536
+# Lists and dicts with more items than this are JSON-encoded a piece at a time
+LARGE_LIST = 1000
+
+def escape_value(value):
+    """
+    Return a parameter value escaped ready for signing and posting, as a list
+    of pieces so that a big value never has to be held as one string.
+    Small values, which are most of them, come back as a single piece.
+    The API Marshalling guide just says that dicts and lists should be in
+    JSON format.
+    """
+    if (isinstance(value, dict) or isinstance(value, list)) and len(value) > LARGE_LIST:
+        pieces = json.JSONEncoder().iterencode(value)
+    else:
+        if isinstance(value, dict) or isinstance(value, list):
+            value = json.dumps(value)
+        value = oauth._utf8_str(value)
+        if len(value) <= CHUNK_SIZE:
+            return [oauth.escape(value)]
+        pieces = [value[i:i + CHUNK_SIZE] for i in xrange(0, len(value), CHUNK_SIZE)]
+    result, buf, size = [], [], 0
+    for p in pieces:
+        buf.append(p)
+        size += len(p)
+        if size >= CHUNK_SIZE:
+            result.append(oauth.escape(''.join(buf)))
+            buf, size = [], 0
+    if buf:
+        result.append(oauth.escape(''.join(buf)))
+    return result
+
+def escape_params(params):
+    """Escape a dict of parameters into a list of (name, [value pieces])"""
+    return [(oauth.escape(oauth._utf8_str(k)), escape_value(v)) for k, v in params.items()]
+
+class PostBody(object):
+    """
+    The body of a POST request, made from escaped parameters, which is read
+    out a piece at a time rather than built as one big string.
+    """
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.length = sum([len(k) + 1 + sum(map(len, v)) for k, v in pairs]) + len(pairs) - 1
+        self.pieces = self.iter_pieces()
+        self.buffer = ''
+
+    def iter_pieces(self):
+        for i, (k, v) in enumerate(self.pairs):
+            yield '%s%s=' % (i and '&' or '', k)
+            for piece in v:
+                yield piece
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += self.pieces.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def __str__(self):
+        return ''.join(self.iter_pieces())
+
 class DictObj(dict):
     """ A dict that also supports d.key syntax as an alias for d['key'] """
     def __getattr__(self, name):
         return self[name]
 
 class Coda(object):
-    def __init__(self, access_token_string, api_url, consumer):
+    def __init__(self, access_token_string, api_url, consumer, transport=None, timeout=None,
+                 breakers=None, splitter=None, profiler=None):
         self.api_url = api_url
         self.consumer = consumer
         self.access_token = oauth.OAuthToken.from_string(access_token_string)
+        # The transport actually sends the requests - see transport.py
+        self.transport = transport or UrllibTransport()
+        self.timeout = timeout
+        # Circuit breakers for each family of calls - see breaker.py
+        self.breakers = breakers or BreakerRegistry()
+        # Splits calls with long lists of UUIDs - see splitting.py
+        self.splitter = splitter or Splitter()
+        # Times the stages of a sample of calls - see profiling.py
+        self.profiler = profiler
 
     def get_url_and_postdata(self, method, parameters={}):
         oauth_request = oauth.OAuthRequest.from_consumer_and_token(self.consumer,
@@ -106,26 +225,177 @@ class Coda(object):
         return oauth_request.get_normalized_http_url(), oauth_request.to_postdata()
     
     def callMethod(self, method, **kwargs):
-        if not method.endswith('/'):
-            method += '/'
-        params = {}
+        # A _timeout keyword overrides the default timeout for this call only.
+        # Calls with long lists of UUIDs are split up - see PreparedCall.
         # print "Calling %s with kwargs %s" % (method, kwargs)
-        # API Marshalling guide just says that dicts and lists should be in JSON format
-        for k in kwargs:
-            v = kwargs[k]
-            if isinstance(v, dict) or isinstance(v, list):
-                params[k] = json.dumps(v)
-            else:
-                params[k] = v
-        url, postdata = self.get_url_and_postdata(method, params)
-        response = urllib2.urlopen(url, postdata)
-        data = response.read()
+        return PreparedCall(self, method)(**kwargs)
+
+    def send_request(self, method, url, postdata, timeout=None, trace=None):
+        """
+        Send a signed request through the circuit breaker, and return its response.
+        'trace' is the profiling.Trace for the call, if it's being profiled.
+        """
+        breaker = self.breakers.get(method)
+        permit = breaker.allow()
+        if not permit:
+            raise CodaCircuitOpen("Not calling %s: the '%s' circuit breaker is open"
+                                  % (method, breaker.name))
+        ok = False
+        start = time.time()
+        try:
+            data = self.transport.request(url, postdata, timeout or self.timeout)
+            ok = True
+        except urllib2.HTTPError, e:
+            # Timeouts, network errors and server errors - anything but a
+            # response - count against the breaker; the server rejecting a
+            # bad request doesn't.
+            ok = e.code < 500
+            raise
+        finally:
+            breaker.record(ok, time.time() - start, permit)
+            if trace:
+                trace.mark('transport')
         result = json.loads(data)
+        if trace:
+            trace.mark('json.loads')
+            trace.finish()
         if result['result'] == 'OK':
             return result.get('response', None)
         else:
             raise CodaException(result['error'])
     
+    def prepare(self, method, **kwargs):
+        """
+        Return a PreparedCall for calling 'method' repeatedly with the given
+        parameters, plus any others passed each time it's called.
+        """
+        return PreparedCall(self, method, **kwargs)
+
+    def iter_records(self, method, **kwargs):
+        """
+        Fetch the records from a list call such as getSources in chunks, yielding
+        them one at a time. See paging.PagedFetch for the options.
+        """
+        import paging
+        return paging.PagedFetch(self, method, **kwargs)
+
+    def write_behind(self, **kwargs):
+        """
+        Return a queue which merges and sends modifyDisplay/modifySource calls
+        in the background. See writebehind.WriteBehindQueue for the options.
+        """
+        import writebehind
+        return writebehind.WriteBehindQueue(self, **kwargs)
+
     def __getattr__(self, name):
         return lambda *args, **kwargs: self.callMethod(name, *args, **kwargs)
-                    
\ No newline at end of file
+
+class PreparedCall(object):
+    """
+    A call to one API method with some of its parameters fixed, for use in
+    loops where only a few parameters change from call to call:
+
+        assign = c.prepare('assignSource', source_uuid=su)
+        for du in display_uuids:
+            assign(display_uuids=[du])
+
+    Everything that doesn't change - the URL, the fixed parameters (encoded
+    and escaped), the OAuth key and the start of the signature - is worked
+    out once here, so each call only has to deal with the nonce, timestamp,
+    varying parameters and the signature itself.
+
+    Each parameter is escaped just once, and the signature and the request
+    body are both made from those escaped pieces as they are needed, so a
+    call with a huge list of UUIDs only holds about one copy of it.  If the
+    list is long enough, the call is split up by the Coda object's splitter.
+    """
+    def __init__(self, coda, method, **kwargs):
+        if not method.endswith('/'):
+            method += '/'
+        self.coda = coda
+        self.method = method
+        self.kwargs = kwargs
+        request = oauth.OAuthRequest('POST', coda.api_url + method)
+        self.url = request.get_normalized_http_url()
+        signature_method = oauth.OAuthSignatureMethod_HMAC_SHA1()
+        fixed = dict(kwargs)
+        fixed.update({
+            'oauth_consumer_key': coda.consumer.key,
+            'oauth_token': coda.access_token.key,
+            'oauth_version': oauth.OAuthRequest.version,
+            'oauth_signature_method': signature_method.get_name(),
+        })
+        self.fixed = escape_params(fixed)
+        self.fixed_names = set(fixed)
+        # The signature is an HMAC of 'METHOD&url&parameters', so we can
+        # feed it the first two parts now, and copy it for each call.
+        key = '%s&%s' % (oauth.escape(coda.consumer.secret), oauth.escape(coda.access_token.secret))
+        base = '%s&%s&' % (oauth.escape(request.get_normalized_http_method()), oauth.escape(self.url))
+        self.hmac = hmac.new(key, base, hashlib.sha1)
+
+    def get_body(self, kwargs, trace=None):
+        """
+        Return the signed body for a call with these extra parameters,
+        marking the stages on 'trace' if the call is being profiled.  It's a
+        PostBody if any of the parameters are big, otherwise just a string.
+        """
+        params = dict(kwargs)
+        params['oauth_nonce'] = oauth.generate_nonce()
+        params['oauth_timestamp'] = oauth.generate_timestamp()
+        if self.fixed_names.intersection(params):
+            names = set([oauth.escape(oauth._utf8_str(k)) for k in params])
+            pairs = [kv for kv in self.fixed if kv[0] not in names]
+        else:
+            pairs = list(self.fixed)
+        if trace:
+            trace.mark('from_consumer_and_token')
+        pairs.extend(escape_params(params))
+        # The names are all different, so this gives the same order as
+        # OAuth's sort by name then value.
+        pairs.sort()
+        small = not [v for k, v in pairs if len(v) > 1]
+        if small:
+            normalized = '&'.join(['%s=%s' % (k, v[0]) for k, v in pairs])
+        if trace:
+            trace.mark('get_normalized_parameters')
+        # Feed the HMAC the escaped form of 'name=value&name=value...'
+        hashed = self.hmac.copy()
+        if small:
+            hashed.update(oauth.escape(normalized))
+        else:
+            for i, (k, v) in enumerate(pairs):
+                hashed.update(oauth.escape('%s%s=' % (i and '&' or '', k)))
+                for piece in v:
+                    hashed.update(oauth.escape(piece))
+        signature = binascii.b2a_base64(hashed.digest())[:-1]
+        if trace:
+            trace.mark('build_signature')
+        if small:
+            body = '%s&oauth_signature=%s' % (normalized, oauth.escape(signature))
+        else:
+            pairs.append(('oauth_signature', [oauth.escape(signature)]))
+            body = PostBody(pairs)
+        if trace:
+            trace.mark('to_postdata')
+        return body
+
+    def __call__(self, **kwargs):
+        timeout = kwargs.pop('_timeout', None)
+        name = self.method.rstrip('/')
+        param = LIST_PARAMS.get(name)
+        if param:
+            # The list may be one of the fixed parameters; if so, each chunk
+            # is passed in place of it.
+            values = kwargs.get(param, self.kwargs.get(param))
+            splitter = self.coda.splitter
+            if splitter.should_split(name, values):
+                kwargs[param] = values
+                return splitter.call(lambda params: self.send(params, timeout), name, param, kwargs)
+        return self.send(kwargs, timeout)
+
+    def send(self, kwargs, timeout=None):
+        """Make the call with these extra parameters, without splitting it up"""
+        profiler = self.coda.profiler
+        trace = profiler and profiler.start(self.method)
+        return self.coda.send_request(self.method, self.url, self.get_body(kwargs, trace),
+                                      timeout, trace)
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+
+# ==========================
+# = Benchmarks for pycoda  =
+# ==========================
+#
+# These measure the time pycoda itself spends on each call, using a transport
+# which answers straight away, so no server or network is involved.
+#
+#     python benchmarks.py
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import sys
+import time
+import random
+import api
+import index
+import profiling
+import splitting
+
+# Find a simplejson library somewhere!
+try:
+    import json  # Python 2.6 onwards
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        "Please install the simplejson module or update to a Python version which includes json"
+
+SOURCE_UUID = '3c554dfe-f094-5f7e-0010-000000006c43'
+DISPLAY_UUIDS = ['3c554dfe-f094-5f7e-0011-%012d' % i for i in range(20)]
+
+class NullTransport(object):
+    """Answers every request with an empty OK response"""
+    data = json.dumps({'result': 'OK', 'response': None})
+    def request(self, url, body=None, timeout=None):
+        return self.data
+
+def get_coda():
+    server = api.CodaServer('benchmark-key', 'benchmark-secret', transport=NullTransport())
+    return server.get_coda("oauth_token_secret=benchmark&oauth_token=benchmark")
+
+def timed(func, n):
+    """Call func() n times, and return the mean time per call in seconds"""
+    start = time.time()
+    for i in xrange(n):
+        func()
+    return (time.time() - start) / n
+
+def bench_callmethod(n):
+    coda = get_coda()
+    return timed(lambda: coda.callMethod('assignSource', source_uuid=SOURCE_UUID,
+                                         display_uuids=DISPLAY_UUIDS), n)
+
+def bench_profiled(n):
+    coda = get_coda()
+    coda.profiler = profiling.Profiler(sample_rate=0.01)
+    return timed(lambda: coda.callMethod('assignSource', source_uuid=SOURCE_UUID,
+                                         display_uuids=DISPLAY_UUIDS), n)
+
+def bench_prepared(n):
+    assign = get_coda().prepare('assignSource', source_uuid=SOURCE_UUID)
+    return timed(lambda: assign(display_uuids=DISPLAY_UUIDS), n)
+
+def bench_large_call(n):
+    # A call with 50,000 UUIDs, read out as the transport would send it
+    class ReadingTransport(NullTransport):
+        def request(self, url, body=None, timeout=None):
+            while body.read(8192):
+                pass
+            return self.data
+    coda = get_coda()
+    coda.transport = ReadingTransport()
+    uuids = ['3c554dfe-f094-5f7e-0011-%012d' % i for i in xrange(50000)]
+    # Send it as one request, rather than letting the splitter break it up
+    coda.splitter = splitting.Splitter(chunk_size=len(uuids))
+    return timed(lambda: coda.assignSource(source_uuid=SOURCE_UUID, display_uuids=uuids),
+                 max(n / 1000, 1))
+
+TAGS = ('news weather nasa lobby reception canteen sales figures twitter feed '
+        'welcome board menu clock calendar stock prices traffic camera').split()
+
+def fake_sources(count):
+    """Sources with names made of three words from a vocabulary of 5000"""
+    rand = random.Random(1)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join([rand.choice(letters) for j in range(rand.randint(4, 9))])
+             for i in range(5000)]
+    return [{'source_uuid': 'src-%d' % i,
+             'name': ' '.join(rand.sample(words, 3)),
+             'tags': rand.sample(TAGS, 2),
+             'type_uuid': 'type-%d' % rand.randint(0, 9)}
+            for i in xrange(count)]
+
+_index = None
+def get_index():
+    """An index of 100,000 sources, built the first time it's needed"""
+    global _index
+    if _index is None:
+        start = time.time()
+        _index = index.RecordIndex(fake_sources(100000))
+        print "(built index of %d sources in %.1fs)" % (len(_index), time.time() - start)
+    return _index
+
+def bench_index_name(n):
+    # What someone might have typed so far, looking for one of the sources
+    idx = get_index()
+    names = [r['name'] for r in fake_sources(1000)]
+    queries = [name[:random.randint(5, len(name))] for name in names]
+    return timed(lambda: idx.search(name=random.choice(queries)), n)
+
+def bench_index_typeahead(n):
+    # The first one or two keystrokes, showing the first 20 matches
+    idx = get_index()
+    queries = [name[:random.randint(1, 2)] for name in [r['name'] for r in fake_sources(1000)]]
+    return timed(lambda: idx.search(name=random.choice(queries), limit=20), n)
+
+def bench_index_tags(n):
+    idx = get_index()
+    return timed(lambda: idx.search(tags=['nasa', 'lobby'], type_uuid='type-3', name='ab'), n)
+
+def bench_index_update(n):
+    idx = get_index()
+    sources = fake_sources(1000)
+    return timed(lambda: idx.add(random.choice(sources)), n)
+
+BENCHMARKS = [
+    ('callMethod assignSource', bench_callmethod),
+    ('callMethod, 1% profiled', bench_profiled),
+    ('prepared assignSource', bench_prepared),
+    ('assignSource to 50000 displays', bench_large_call),
+    ('index search by name', bench_index_name),
+    ('index type-ahead, 1-2 letters', bench_index_typeahead),
+    ('index search by tags/type/name', bench_index_tags),
+    ('index update', bench_index_update),
+]
+
+def main(n=10000):
+    for name, bench in BENCHMARKS:
+        t = bench(n)
+        print "%-32s %8.1f us/call %10.0f calls/s" % (name, t * 1e6, 1 / t)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
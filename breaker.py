@@ -0,0 +1,185 @@
+#
+# Circuit breakers and health tracking for the CODA API.
+#
+# Each family of API calls (by default, all the calls about the same kind of
+# object, such as getSources, createSource and assignSource) has a breaker
+# which watches the error rate and latency of recent calls.  If too many fail
+# or are too slow, the breaker 'opens' and further calls fail straight away
+# with api.CodaCircuitOpen, rather than tying up a thread waiting for a server
+# which is struggling.  After a while, one call is let through as a probe,
+# and if it succeeds the breaker closes again.
+#
+#     s = CodaServer(KEY, SECRET, timeout=(5, 30))
+#     c = s.get_coda(atok)
+#     ...
+#     print s.breakers.stats()
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import bisect
+import re
+import threading
+import time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# What allow() lets a call go ahead as
+CALL, PROBE = 'call', 'probe'
+
+def method_family(method):
+    """
+    The default grouping of calls: by the kind of object they're about,
+    so getSources, createSource and assignSource are all 'source'.
+    """
+    m = re.match(r'[a-z]*(\w*?)s?/?$', method)
+    return (m and m.group(1) or method).lower()
+
+class LatencyHistogram(object):
+    """Counts of latencies, in buckets whose upper bounds are in seconds"""
+    BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(self.BOUNDS, latency)] += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket containing the p'th percentile, or None"""
+        total = sum(self.counts)
+        if not total:
+            return None
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= total * p / 100.0:
+                return i < len(self.BOUNDS) and self.BOUNDS[i] or float('inf')
+
+    def as_dict(self):
+        labels = ['<=%g' % b for b in self.BOUNDS] + ['>%g' % self.BOUNDS[-1]]
+        return dict(zip(labels, self.counts))
+
+class CircuitBreaker(object):
+    def __init__(self, name, window=60.0, min_calls=10, error_rate=0.5,
+                 slow_call=None, reset_timeout=30.0):
+        """
+        window        - seconds of recent calls to look at
+        min_calls     - don't open unless there have been at least this many
+        error_rate    - open when this fraction of recent calls have failed
+        slow_call     - calls taking longer than this many seconds count as failures
+        reset_timeout - seconds to stay open before letting a probe through
+        """
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.calls = deque()    # (time, ok) for calls in the window
+        self.failures = 0       # number of those which weren't ok
+        self.histogram = LatencyHistogram()
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.calls and self.calls[0][0] < now - self.window:
+            if not self.calls.popleft()[1]:
+                self.failures -= 1
+
+    def allow(self):
+        """
+        Should a call go ahead?  Returns None if not, otherwise CALL, or PROBE
+        for the one call let through to test whether the breaker can close.
+        Every call that is allowed must be followed by a record() of how it
+        went, passing it what this returned.
+        """
+        self.lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return CALL
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return PROBE
+            return None
+        finally:
+            self.lock.release()
+
+    def record(self, ok, latency, permit=CALL):
+        """
+        Record the outcome of a call.  Only the probe can close the breaker
+        (or open it again); calls which started before it opened just count
+        towards the error rate.
+        """
+        if self.slow_call is not None and latency > self.slow_call:
+            ok = False
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.histogram.add(latency)
+            if permit == PROBE:
+                self.probing = False
+                if ok:
+                    self.state = CLOSED
+                    self.calls.clear()
+                    self.failures = 0
+                else:
+                    self.state = OPEN
+                    self.opened_at = now
+                return
+            self.calls.append((now, ok))
+            if not ok:
+                self.failures += 1
+            self._expire(now)
+            if (self.state == CLOSED and len(self.calls) >= self.min_calls
+                    and self.failures >= len(self.calls) * self.error_rate):
+                self.state = OPEN
+                self.opened_at = now
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            self._expire(time.time())
+            return {
+                'state': self.state,
+                'calls': len(self.calls),
+                'failures': self.failures,
+                'p50': self.histogram.percentile(50),
+                'p99': self.histogram.percentile(99),
+                'latency': self.histogram.as_dict(),
+            }
+        finally:
+            self.lock.release()
+
+class BreakerRegistry(object):
+    """The circuit breakers for one CODA server, one per family of calls"""
+    def __init__(self, family=method_family, **options):
+        """
+        family  - function mapping a method name to the name of its breaker
+        options - passed on to each CircuitBreaker
+        """
+        self.family = family
+        self.options = options
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, method):
+        name = self.family(method)
+        self.lock.acquire()
+        try:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, **self.options)
+            return self.breakers[name]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """A dict of the state and latency histogram of each breaker"""
+        return dict([(name, b.stats()) for name, b in self.breakers.items()])
@@ -0,0 +1,300 @@
+#! /usr/bin/python
+#
+# Bulk export and import of an organisation's displays, sources and users,
+# as newline-delimited JSON files.
+#
+# Export every display, source and user into the directory 'backup':
+#
+#     python -m pycoda.bulk export -k KEY -s SECRET -t TOKEN -d backup
+#
+# Recreate the sources in another organisation:
+#
+#     python -m pycoda.bulk import -k KEY -s SECRET -t TOKEN2 -d backup sources
+#
+# The work is spread over several processes, each with its own Coda object.
+# Give more than one -t option (or a --token-file with one token per line)
+# to have the processes use different access tokens.
+#
+# Progress is checkpointed next to each data file, so if a run is interrupted,
+# running the same command again carries on from where it got to.  Imports
+# remember each record they have created, so nothing is created twice, and
+# running an import again after some records failed just retries those.
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import httplib
+import os
+import sys
+import time
+import multiprocessing
+from optparse import OptionParser
+import api
+import paging
+import pool
+
+# Find a simplejson library somewhere!
+try:
+    import json  # Python 2.6 onwards
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        "Please install the simplejson module or update to a Python version which includes json"
+
+# kind -> (list call, create call, fields to pass to the create call)
+# Displays are physical things, so can be exported but not created.
+KINDS = {
+    'displays': ('getDisplays', None,           None),
+    'sources':  ('getSources',  'createSource', ['name', 'type_uuid', 'parameters', 'tags']),
+    'users':    ('getUsers',    'createUser',   ['username', 'first_name', 'last_name',
+                                                 'email', 'permission']),
+}
+
+class Checkpoint(object):
+    """Remembers which chunks of a job have been done, in a small JSON file"""
+    def __init__(self, path):
+        self.path = path
+        self.state = {'done': []}
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            self.state = json.load(f)
+            f.close()
+        self.done = set(self.state['done'])
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def mark_done(self, index):
+        self.done.add(index)
+        self.save()
+
+    def save(self):
+        self.state['done'] = sorted(self.done)
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        json.dump(self.state, f)
+        f.close()
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+class RecordLog(object):
+    """
+    Remembers which records of an import have been created, by their line
+    number in the data file.  Each is appended to the file as soon as it's
+    done, so several processes can add to it at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            self.done = set([int(l) for l in f if l.strip()])
+            f.close()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+class Progress(object):
+    """Reports throughput on stderr every few seconds"""
+    def __init__(self, label, every=5.0):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.start = self.last = time.time()
+
+    def add(self, n):
+        self.count += n
+        now = time.time()
+        if now - self.last >= self.every:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        sys.stderr.write("%s: %d records, %.1f records/s\n" % (
+            self.label, self.count, self.count / elapsed))
+
+# Each worker process gets its own Coda object, set up by init_worker.
+_coda = None
+
+def init_worker(key, secret, server_url, tokens, counter):
+    global _coda
+    counter.acquire()
+    try:
+        token = tokens[counter.value % len(tokens)]
+        counter.value += 1
+    finally:
+        counter.release()
+    _coda = api.CodaServer(key, secret, server_url).get_coda(token)
+
+def export_chunk(args):
+    index, method, uuids = args
+    return index, list(paging.PagedFetch(_coda, method, uuids=uuids, chunk_size=len(uuids)))
+
+def import_chunk(args):
+    method, fields, records, password, log_path = args
+    created, errors = 0, []
+    log = open(log_path, 'a')
+    try:
+        for n, r in records:
+            params = dict([(f, r[f]) for f in fields if f in r])
+            if method == 'createUser':
+                params['password'] = password
+            name = params.get('name', params.get('username'))
+            try:
+                _coda.callMethod(method, **params)
+            except api.CodaException, e:
+                errors.append((name, e.msg))
+                continue
+            except (IOError, httplib.HTTPException), e:
+                # Network trouble only loses this record; it's retried next run
+                errors.append((name, str(e) or e.__class__.__name__))
+                continue
+            log.write('%d\n' % n)
+            log.flush()
+            created += 1
+    finally:
+        log.close()
+    return created, errors
+
+def export_kind(coda, executor, kind, path, options):
+    method = KINDS[kind][0]
+    ckpt = Checkpoint(path + '.checkpoint')
+    if ckpt.exists():
+        # Throw away anything written after the last checkpoint
+        uuids = ckpt.state['uuids']
+        out = open(path, 'r+')
+        out.truncate(ckpt.state['offset'])
+        out.seek(0, 2)
+    else:
+        uuids = coda.iter_records(method).list_uuids()
+        ckpt.state['uuids'] = uuids
+        ckpt.state['offset'] = 0
+        ckpt.save()
+        out = open(path, 'w')
+    size = options.chunk_size
+    chunks = ((i, method, uuids[i:i + size]) for i in xrange(0, len(uuids), size)
+              if i not in ckpt.done)
+    progress = Progress('export %s' % kind)
+    for i, records in pool.imap_ordered(export_chunk, chunks, options.processes, executor=executor):
+        for r in records:
+            out.write(json.dumps(r) + '\n')
+        out.flush()
+        os.fsync(out.fileno())
+        ckpt.state['offset'] = out.tell()
+        ckpt.mark_done(i)
+        progress.add(len(records))
+    out.close()
+    ckpt.remove()
+    progress.report()
+
+def read_chunks(path, size, skip):
+    """
+    Yield lists of up to 'size' (line number, record) pairs, leaving out the
+    line numbers in 'skip'
+    """
+    f = open(path, 'r')
+    chunk = []
+    for n, line in enumerate(f):
+        if line.strip() and n not in skip:
+            chunk.append((n, json.loads(line)))
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+    f.close()
+
+def import_kind(executor, kind, path, options):
+    method, create, fields = KINDS[kind]
+    if create is None:
+        raise api.CodaException("Can't create %s" % kind)
+    if create == 'createUser' and not options.password:
+        raise api.CodaException("Importing users needs a --password for them")
+    log = RecordLog(path + '.import-log')
+    progress = Progress('import %s' % kind)
+    chunks = ((create, fields, records, options.password, log.path)
+              for records in read_chunks(path, options.chunk_size, log.done))
+    failed = 0
+    for created, errors in pool.imap_ordered(import_chunk, chunks, options.processes,
+                                             executor=executor):
+        for name, msg in errors:
+            sys.stderr.write("Couldn't create %s: %s\n" % (name, msg))
+        failed += len(errors)
+        progress.add(created)
+    if failed:
+        sys.stderr.write("Run the import again to retry the %d %s which failed\n" % (failed, kind))
+    else:
+        log.remove()
+    progress.report()
+    return failed
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog export|import [options] [kind ...]\n\n"
+                          "kinds are: " + ", ".join(sorted(KINDS)))
+    parser.add_option('-k', '--key', help="consumer key")
+    parser.add_option('-s', '--secret', help="consumer secret")
+    parser.add_option('-t', '--token', action='append', default=[],
+                      help="access token string; may be given more than once")
+    parser.add_option('--token-file', help="file containing access tokens, one per line")
+    parser.add_option('-u', '--server-url', default=api.CODA_SERVER_URL)
+    parser.add_option('-d', '--dir', default='.', help="directory for the .jsonl files")
+    parser.add_option('-p', '--processes', type='int', default=4)
+    parser.add_option('-c', '--chunk-size', type='int', default=100)
+    parser.add_option('--password', help="initial password for imported users")
+    parser.add_option('--restart', action='store_true',
+                      help="ignore any checkpoints and start again")
+    options, args = parser.parse_args(argv)
+
+    if not args or args[0] not in ('export', 'import'):
+        parser.error("Please say whether to export or import")
+    command, kinds = args[0], args[1:]
+    if command == 'export':
+        kinds = kinds or sorted(KINDS)
+    elif not kinds:
+        parser.error("Please say what to import")
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error("Unknown kind %s" % kind)
+    tokens = list(options.token)
+    if options.token_file:
+        tf = open(options.token_file, 'r')
+        tokens += [l.strip().strip('"') for l in tf if l.strip()]
+        tf.close()
+    if not (options.key and options.secret and tokens):
+        parser.error("Need a consumer key, secret and at least one access token")
+
+    if options.restart:
+        for kind in kinds:
+            path = os.path.join(options.dir, kind + '.jsonl')
+            Checkpoint(path + '.checkpoint').remove()
+            RecordLog(path + '.import-log').remove()
+
+    counter = multiprocessing.Value('i', 0)
+    executor = multiprocessing.Pool(options.processes, init_worker,
+        (options.key, options.secret, options.server_url, tokens, counter))
+    failed = 0
+    try:
+        if command == 'export':
+            if not os.path.isdir(options.dir):
+                os.makedirs(options.dir)
+            coda = api.CodaServer(options.key, options.secret, options.server_url).get_coda(tokens[0])
+            for kind in kinds:
+                export_kind(coda, executor, kind, os.path.join(options.dir, kind + '.jsonl'), options)
+        else:
+            for kind in kinds:
+                failed += import_kind(executor, kind, os.path.join(options.dir, kind + '.jsonl'), options)
+    finally:
+        executor.terminate()
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
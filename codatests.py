@@ -15,8 +15,24 @@
 
 import unittest
 import api
-import os, sys, webbrowser, urllib2, time
+import paging
+import watcher
+import writebehind
+import pool
+import bulk
+import transport
+import breaker
+import index
+import splitting
+import profiling
+import fanout
+import tokenstore
+import oauth
+import cgi
+import os, sys, webbrowser, urllib2, httplib, time, socket
 import random
+import tempfile, shutil
+from multiprocessing.pool import ThreadPool
 
 # Please create new test keys yourself and replace these. See api.py for info.
 # You CERTAINLY SHOULD NOT use these for any real application.
@@ -162,6 +178,609 @@ class AuthTestCase(unittest.TestCase):
         srch_src = self.coda.getSources(name=new_source_name)
         self.assertEqual(len(srch_src), 0)
         
+class FakeCoda(object):
+    """
+    Stands in for a Coda object in the tests which don't need the server.
+    Serves getSources/getDisplays from a fixed list of records and
+    remembers the calls that were made.
+    """
+    def __init__(self, records, id_field='source_uuid', failures=0, error=None):
+        self.records = records
+        self.id_field = id_field
+        self.failures = failures
+        self.error = error or api.CodaException("Simulated failure")
+        self.calls = []
+
+    def callMethod(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        for k, v in kwargs.items():
+            if k.endswith('_uuids'):
+                wanted = set(v)
+                return [r for r in self.records if r[self.id_field] in wanted]
+        return list(self.records)
+
+def fake_sources(n):
+    return [{'source_uuid': 'src-%04d' % i, 'name': 'Source %d' % i} for i in range(n)]
+
+class PagingTestCase(unittest.TestCase):
+
+    def testChunks(self):
+        coda = FakeCoda(fake_sources(25))
+        fetch = paging.PagedFetch(coda, 'getSources', chunk_size=10, workers=3)
+        self.assertEqual(list(fetch), coda.records)
+        # One listing call, then three chunks
+        self.assertEqual(len(coda.calls), 4)
+
+    def testRetryAndResume(self):
+        coda = FakeCoda(fake_sources(25), failures=1, error=urllib2.URLError("Simulated failure"))
+        uuids = [r['source_uuid'] for r in coda.records]
+        fetch = paging.PagedFetch(coda, 'getSources', uuids=uuids, chunk_size=10,
+                                  retry_delay=0, cursor=10)
+        self.assertEqual(list(fetch), coda.records[10:])
+        self.assertEqual(fetch.cursor, 25)
+        # The server rejecting a call isn't retried
+        coda = FakeCoda(fake_sources(25), failures=1)
+        fetch = paging.PagedFetch(coda, 'getSources', uuids=uuids, retry_delay=0)
+        self.assertRaises(api.CodaException, list, fetch)
+        self.assertEqual(len(coda.calls), 1)
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.coda = FakeCoda([{'display_uuid': 'd%d' % i, 'tags': []} for i in range(3)],
+                             id_field='display_uuid')
+        self.watcher = watcher.Watcher(self.coda, min_interval=1, max_interval=8, backoff=2)
+
+    def testDeltas(self):
+        self.assertEqual(len(self.watcher.poll().added), 3)
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual(self.watcher.interval, 4)
+        self.coda.records = self.coda.records[1:]
+        self.coda.records[0] = {'display_uuid': 'd1', 'tags': ['lobby']}
+        delta = self.watcher.poll()
+        self.assertEqual([d['display_uuid'] for d in delta.changed], ['d1'])
+        self.assertEqual([d['display_uuid'] for d in delta.removed], ['d0'])
+        self.assertEqual(self.watcher.interval, 1)
+
+    def testSharedSubscribers(self):
+        self.watcher.min_interval = 0.01
+        got = []
+        sub = self.watcher.subscribe(got.append)
+        thread = self.watcher.thread
+        deltas = self.watcher.deltas(timeout=5)
+        first = deltas.next()
+        deltas.close()
+        sub.cancel()
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+        self.assertTrue(self.watcher.thread is None)
+        self.assertEqual(len(first.added), 3)
+        self.assertEqual(len(got), 1)
+
+        # Subscribing again starts polling again
+        deltas = self.watcher.deltas(timeout=5)
+        self.assertEqual(len(deltas.next().added), 3)
+        self.coda.records = self.coda.records[1:]
+        self.watcher.wakeup.set()
+        self.assertEqual(len(deltas.next().removed), 1)
+        thread = self.watcher.thread
+        deltas.close()
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+
+    def testFaultySubscriber(self):
+        def broken(delta):
+            raise ValueError("Subscriber bug")
+        errors, got = [], []
+        self.watcher.subscriptions = [watcher.Subscription(self.watcher, broken, errors.append),
+                                      watcher.Subscription(self.watcher, got.append)]
+        self.watcher.poll()
+        self.assertEqual(len(got), 1)
+        self.assertTrue(isinstance(errors[0], ValueError))
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    def testCoalescing(self):
+        coda = FakeCoda([])
+        q = writebehind.WriteBehindQueue(coda, max_delay=60)
+        f1 = q.submit('modifyDisplay', display_uuid='d1', tags=['a'], name='Lobby')
+        f2 = q.submit('modifyDisplay', display_uuid='d1', tags=['a', 'b'])
+        f3 = q.submit('modifyDisplay', display_uuid='d2', tags=[])
+        q.close()
+        self.assertTrue(f1.done() and f2.done() and f3.done())
+        self.assertEqual(len(coda.calls), 2)
+        self.assertTrue(('modifyDisplay', {'display_uuid': 'd1', 'tags': ['a', 'b'],
+                                           'name': 'Lobby'}) in coda.calls)
+
+    def testFailure(self):
+        coda = FakeCoda([], failures=1)
+        q = writebehind.WriteBehindQueue(coda, max_pending=1)
+        f = q.submit('modifySource', source_uuid='s1', name='x')
+        self.assertTrue(isinstance(f.exception(5), api.CodaException))
+        self.assertRaises(api.CodaException, f.result)
+        q.close()
+
+    def testFailingCallback(self):
+        coda = FakeCoda([])
+        q = writebehind.WriteBehindQueue(coda, max_delay=60)
+        f1 = q.submit('modifyDisplay', display_uuid='d1', name='Lobby')
+        f2 = q.submit('modifyDisplay', display_uuid='d2', name='Canteen')
+        called = []
+        def broken(f):
+            raise ValueError("Callback bug")
+        f1.add_done_callback(broken)
+        f1.add_done_callback(called.append)
+        # Keep the logged traceback out of the test output
+        logger = pool.log
+        logger.disabled = True
+        try:
+            q.close()
+        finally:
+            logger.disabled = False
+        self.assertTrue(f1.done() and f2.done())
+        self.assertEqual(called, [f1])
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sources.jsonl')
+        self.coda = bulk._coda = FakeCoda(fake_sources(25))
+        self.executor = ThreadPool(2)
+        self.options = bulk.OptionParser().get_default_values()
+        self.options.chunk_size = 10
+        self.options.processes = 2
+        self.options.password = None
+
+    def tearDown(self):
+        self.executor.terminate()
+        shutil.rmtree(self.dir)
+
+    def testExportResume(self):
+        # Pretend an earlier run got through the first chunk, and wrote
+        # half of the second before dying.
+        ckpt = bulk.Checkpoint(self.path + '.checkpoint')
+        ckpt.state['uuids'] = [r['source_uuid'] for r in self.coda.records]
+        first = ''.join([json.dumps(r) + '\n' for r in self.coda.records[:10]])
+        ckpt.state['offset'] = len(first)
+        ckpt.mark_done(0)
+        f = open(self.path, 'w')
+        f.write(first + json.dumps(self.coda.records[10]) + '\n')
+        f.close()
+        bulk.export_kind(self.coda, self.executor, 'sources', self.path, self.options)
+        f = open(self.path, 'r')
+        self.assertEqual([json.loads(l) for l in f], self.coda.records)
+        f.close()
+        self.assertFalse(ckpt.exists())
+        self.assertEqual(len(self.coda.calls), 2)
+
+    def testImport(self):
+        f = open(self.path, 'w')
+        for r in self.coda.records:
+            f.write(json.dumps(dict(r, type_uuid='t', source_uuid='x')) + '\n')
+        f.close()
+        self.assertEqual(bulk.import_kind(self.executor, 'sources', self.path, self.options), 0)
+        self.assertEqual(len(self.coda.calls), 25)
+        self.assertTrue(('createSource', {'name': 'Source 0', 'type_uuid': 't'}) in self.coda.calls)
+
+    def testImportResume(self):
+        f = open(self.path, 'w')
+        for r in self.coda.records:
+            f.write(json.dumps(dict(r, type_uuid='t')) + '\n')
+        f.close()
+        # An earlier run created the first five sources before it was interrupted
+        f = open(self.path + '.import-log', 'w')
+        f.write('0\n1\n2\n3\n4\n')
+        f.close()
+        self.coda.failures = 1
+        self.coda.error = urllib2.URLError("Simulated failure")
+        self.assertEqual(bulk.import_kind(self.executor, 'sources', self.path, self.options), 1)
+        self.assertEqual(len(self.coda.calls), 20)
+        self.assertFalse(('createSource', {'name': 'Source 0', 'type_uuid': 't'}) in self.coda.calls)
+        # Running it again just retries the one which failed
+        self.coda.calls = []
+        self.assertEqual(bulk.import_kind(self.executor, 'sources', self.path, self.options), 0)
+        self.assertEqual(len(self.coda.calls), 1)
+        self.assertFalse(os.path.exists(self.path + '.import-log'))
+
+class CannedTransport(object):
+    """A transport which answers every API call with the same response"""
+    def __init__(self, response=None):
+        self.data = json.dumps({'result': 'OK', 'response': response})
+        self.requests = []
+        self.failing = False
+
+    def request(self, url, body=None, timeout=None):
+        self.requests.append((url, body and str(body)))
+        if self.failing:
+            raise urllib2.URLError("Simulated failure")
+        return self.data
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp('.cassette')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testRecordReplay(self):
+        recorder = transport.RecordingTransport(self.path, CannedTransport([{'name': 'NASA'}]))
+        coda = api.CodaServer(TEST_KEY, TEST_SECRET, transport=recorder).get_coda(
+            "oauth_token_secret=s&oauth_token=t")
+        self.assertEqual(coda.getSources(name='NASA'), [{'name': 'NASA'}])
+        recorder.close()
+
+        # Replaying gives the same answer, even though the nonce etc. have changed
+        coda.transport = transport.ReplayTransport(self.path)
+        self.assertEqual(coda.getSources(name='NASA'), [{'name': 'NASA'}])
+        self.assertRaises(transport.CassetteError, lambda: coda.getSources(name='ESA'))
+
+        replay = coda.transport
+        stats = transport.generate_load(coda, self.path, threads=2, repeat=5)
+        self.assertEqual(stats['calls'], 10)
+        self.assertEqual(stats['errors'], 0)
+        self.assertTrue(coda.transport is replay)
+
+    def testRecordFailures(self):
+        canned = CannedTransport()
+        recorder = transport.RecordingTransport(self.path, canned)
+        canned.failing = True
+        self.assertRaises(urllib2.URLError, recorder.request, 'http://example.com/a')
+        canned.request = lambda url, body=None, timeout=None: time.sleep('not a number')
+        self.assertRaises(TypeError, recorder.request, 'http://example.com/b')
+        def timeout(url, body=None, timeout=None):
+            raise socket.timeout("timed out")
+        canned.request = timeout
+        self.assertRaises(socket.timeout, recorder.request, 'http://example.com/c')
+        recorder.close()
+
+        # Only the transport failures were recorded, and they happen again on replay
+        replay = transport.ReplayTransport(self.path)
+        self.assertEqual(len(replay.entries), 2)
+        self.assertRaises(urllib2.URLError, replay.request, 'http://example.com/a')
+        self.assertRaises(socket.timeout, replay.request, 'http://example.com/c')
+
+class BreakerTestCase(unittest.TestCase):
+
+    def testOpenAndRecover(self):
+        canned = CannedTransport([])
+        server = api.CodaServer(TEST_KEY, TEST_SECRET, transport=canned,
+                                breakers=breaker.BreakerRegistry(min_calls=3, reset_timeout=60))
+        coda = server.get_coda("oauth_token_secret=s&oauth_token=t")
+        canned.failing = True
+        for i in range(3):
+            self.assertRaises(urllib2.URLError, coda.getSources)
+        self.assertRaises(api.CodaCircuitOpen, coda.createSource)
+        self.assertEqual(len(canned.requests), 3)
+        # Other families of calls are unaffected
+        self.assertRaises(urllib2.URLError, coda.getDisplays)
+
+        # Once the reset timeout has passed, a successful probe closes it again
+        sources = server.breakers.get('getSources')
+        sources.opened_at -= 60
+        canned.failing = False
+        self.assertEqual(coda.getSources(), [])
+        self.assertEqual(server.breakers.stats()['source']['state'], breaker.CLOSED)
+
+    def testOnlyProbeCloses(self):
+        b = breaker.CircuitBreaker('source', min_calls=1, reset_timeout=60)
+        slow = b.allow()
+        self.assertEqual(slow, breaker.CALL)
+        b.record(False, 0.1, b.allow())
+        self.assertEqual(b.state, breaker.OPEN)
+        b.opened_at -= 60
+        probe = b.allow()
+        self.assertEqual(probe, breaker.PROBE)
+        self.assertEqual(b.allow(), None)
+        # The call from before it opened finishing doesn't close it...
+        b.record(True, 5.0, slow)
+        self.assertEqual(b.state, breaker.HALF_OPEN)
+        # ...but the probe's result decides
+        b.record(False, 0.1, probe)
+        self.assertEqual(b.state, breaker.OPEN)
+
+    def testOtherFailures(self):
+        canned = CannedTransport([])
+        server = api.CodaServer(TEST_KEY, TEST_SECRET, transport=canned,
+                                breakers=breaker.BreakerRegistry(min_calls=3, reset_timeout=60))
+        coda = server.get_coda("oauth_token_secret=s&oauth_token=t")
+        def bad_status(url, body=None, timeout=None):
+            raise httplib.BadStatusLine('')
+        canned.request = bad_status
+        for i in range(3):
+            self.assertRaises(httplib.BadStatusLine, coda.getSources)
+        self.assertRaises(api.CodaCircuitOpen, coda.getSources)
+        # The server turning down a bad request doesn't count
+        def bad_request(url, body=None, timeout=None):
+            raise urllib2.HTTPError(url, 400, "Bad Request", {}, None)
+        canned.request = bad_request
+        for i in range(3):
+            self.assertRaises(urllib2.HTTPError, coda.getDisplays)
+        self.assertEqual(server.breakers.stats()['display']['state'], breaker.CLOSED)
+
+class PreparedCallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.canned = CannedTransport()
+        self.coda = api.CodaServer(TEST_KEY, TEST_SECRET, transport=self.canned).get_coda(
+            "oauth_token_secret=s&oauth_token=t")
+        self.generate_nonce, self.generate_timestamp = oauth.generate_nonce, oauth.generate_timestamp
+        oauth.generate_nonce = lambda length=8: '12345678'
+        oauth.generate_timestamp = lambda: 1300000000
+
+    def tearDown(self):
+        oauth.generate_nonce, oauth.generate_timestamp = self.generate_nonce, self.generate_timestamp
+
+    def testSameRequest(self):
+        """Calls should be signed and sent just as the oauth module would do it"""
+        display_uuids = ['d1', u'd\xe92']
+        url, postdata = self.coda.get_url_and_postdata('assignSource/',
+            {'source_uuid': 's 1', 'display_uuids': json.dumps(display_uuids)})
+        self.coda.assignSource(source_uuid='s 1', display_uuids=display_uuids)
+        assign = self.coda.prepare('assignSource', source_uuid='s 1')
+        assign(display_uuids=display_uuids)
+        # Overriding a fixed parameter
+        self.coda.prepare('assignSource', source_uuid='x')(source_uuid='s 1',
+                                                          display_uuids=display_uuids)
+        for req_url, body in self.canned.requests:
+            self.assertEqual(req_url, url)
+            self.assertEqual(cgi.parse_qs(body), cgi.parse_qs(postdata))
+
+    def testLargeBody(self):
+        """Big parameters are escaped in pieces, and streamed out in pieces"""
+        display_uuids = ['3c554dfe-f094-5f7e-0011-%012d' % i for i in range(10000)]
+        url, postdata = self.coda.get_url_and_postdata('assignSource/',
+            {'source_uuid': 's 1', 'display_uuids': json.dumps(display_uuids)})
+        body = self.coda.prepare('assignSource').get_body(
+            {'source_uuid': 's 1', 'display_uuids': display_uuids})
+        self.assertTrue(max([len(p) for k, v in body.pairs for p in v]) < 2 * api.CHUNK_SIZE)
+        # Small calls are just signed and sent as a string
+        small = self.coda.prepare('assignSource').get_body({'display_uuids': display_uuids[:10]})
+        self.assertTrue(isinstance(small, str))
+        self.assertEqual(len(body), len(postdata))
+        data = ''.join(iter(lambda: body.read(8192), ''))
+        self.assertEqual(cgi.parse_qs(data), cgi.parse_qs(postdata))
+
+class IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sources = [
+            {'source_uuid': 's1', 'name': 'NASA Image of the Day', 'tags': ['space'], 'type_uuid': 'html'},
+            {'source_uuid': 's2', 'name': 'BBC News', 'tags': ['news', 'lobby'], 'type_uuid': 'rss'},
+            {'source_uuid': 's3', 'name': 'Nasa TV', 'tags': ['space', 'lobby'], 'type_uuid': 'video'},
+            {'source_uuid': 's4', 'name': 'TV', 'tags': [], 'type_uuid': 'video'},
+        ]
+        self.idx = index.RecordIndex(self.sources)
+
+    def uuids(self, **kwargs):
+        return [r['source_uuid'] for r in self.idx.search(**kwargs)]
+
+    def testSearch(self):
+        # Should match a case-insensitive substring search over everything
+        for name in ['nasa', 'NASA', 'as', 'tv', 'v', ' of the', 'news', 'x', 'nasa tv']:
+            expected = [r['source_uuid'] for r in self.sources if name.lower() in r['name'].lower()]
+            self.assertEqual(self.uuids(name=name), expected, name)
+        self.assertEqual(self.uuids(tags=['space', 'lobby']), ['s3'])
+        self.assertEqual(self.uuids(type_uuid='video', name='nasa'), ['s3'])
+        self.assertEqual(self.uuids(tags=['nothing']), [])
+        self.assertEqual(len(self.uuids()), 4)
+
+    def testLimit(self):
+        self.assertEqual(self.uuids(name='a', limit=2), ['s1', 's3'])
+        self.assertEqual(self.uuids(name='tv', limit=1), ['s3'])
+        self.assertEqual(self.uuids(tags=['lobby'], name='n', limit=5), ['s2', 's3'])
+        self.assertEqual(self.uuids(limit=3), ['s1', 's2', 's3'])
+
+    def testUpdates(self):
+        changed = dict(self.sources[1], name='CNN', tags=['news'])
+        self.idx.apply(watcher.Delta([{'source_uuid': 's5', 'name': 'Nasa Live'}], [changed],
+                                     [self.sources[0]], []))
+        self.assertEqual(self.uuids(name='nasa'), ['s3', 's5'])
+        self.assertEqual(self.uuids(name='bbc'), [])
+        self.assertEqual(self.uuids(name='cnn'), ['s2'])
+        self.assertEqual(self.uuids(tags=['lobby']), ['s3'])
+
+class EchoTransport(object):
+    """Answers getSources(source_uuids=...) with a record for each UUID asked for"""
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, url, body=None, timeout=None):
+        self.requests += 1
+        uuids = json.loads(cgi.parse_qs(str(body))['source_uuids'][0])
+        return json.dumps({'result': 'OK', 'response': [{'source_uuid': u} for u in uuids]})
+
+class SplittingTestCase(unittest.TestCase):
+
+    def testSplit(self):
+        echo = EchoTransport()
+        splitter = splitting.Splitter(chunk_size=100, min_size=10, max_size=500, target_latency=60)
+        coda = api.CodaServer(TEST_KEY, TEST_SECRET, transport=echo, splitter=splitter).get_coda(
+            "oauth_token_secret=s&oauth_token=t")
+        uuids = ['src-%04d' % i for i in range(1050)]
+        self.assertEqual([r['source_uuid'] for r in coda.getSources(source_uuids=uuids)], uuids)
+        self.assertEqual(echo.requests, 11)
+        metrics = splitter.metrics()['getSources']
+        self.assertEqual(metrics['chunks'], 11)
+        self.assertTrue(metrics['chunk_size'] > 100)
+        # Short lists aren't split
+        coda.getSources(source_uuids=uuids[:10])
+        self.assertEqual(echo.requests, 12)
+        # Prepared calls are split too, whether the list is passed in or fixed
+        for call, kwargs in [(coda.prepare('getSources'), {'source_uuids': uuids}),
+                             (coda.prepare('getSources', source_uuids=uuids), {})]:
+            before = echo.requests
+            self.assertEqual([r['source_uuid'] for r in call(**kwargs)], uuids)
+            self.assertTrue(echo.requests - before > 1)
+
+    def testMerge(self):
+        canned = CannedTransport(7)
+        splitter = splitting.Splitter(chunk_size=10, min_size=10)
+        coda = api.CodaServer(TEST_KEY, TEST_SECRET, transport=canned, splitter=splitter).get_coda(
+            "oauth_token_secret=s&oauth_token=t")
+        display_uuids = ['d%d' % i for i in range(25)]
+        self.assertEqual(coda.assignSource(source_uuid='s1', display_uuids=display_uuids), 7)
+        self.assertEqual(len(canned.requests), 3)
+        # Responses which don't agree can't be passed off as one
+        responses = iter([1, 2, 3])
+        canned.request = lambda url, body=None, timeout=None: json.dumps(
+            {'result': 'OK', 'response': responses.next()})
+        self.assertRaises(api.CodaException, coda.assignSource, source_uuid='s1',
+                          display_uuids=display_uuids)
+
+    def testAdapt(self):
+        splitter = splitting.Splitter(chunk_size=100, min_size=10, target_latency=1)
+        sizer = splitter.sizer('assignSource')
+        splitter.record(sizer, 5)
+        self.assertEqual(sizer.size, 50)
+        splitter.record(sizer, 0.1)
+        self.assertEqual(sizer.size, 63)
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def testProfile(self):
+        profiler = profiling.Profiler(sample_rate=1.0)
+        coda = api.CodaServer(TEST_KEY, TEST_SECRET, transport=CannedTransport([]),
+                              profiler=profiler).get_coda("oauth_token_secret=s&oauth_token=t")
+        for i in range(5):
+            coda.getSources(name='NASA')
+        coda.prepare('assignSource', source_uuid='s1')(display_uuids=['d1'])
+        self.assertEqual(profiler.stats['getSources'].calls, 5)
+        self.assertEqual(profiler.stats['assignSource'].calls, 1)
+        self.assertEqual(len(profiler.folded()), 2 * len(profiling.STAGES))
+        self.assertEqual(len(profiler.table().splitlines()), 3)
+
+        profiler.reset()
+        profiler.sample_rate = 0
+        coda.getSources()
+        self.assertEqual(profiler.stats, {})
+
+class FleetTransport(object):
+    """Serves getDisplays for several organisations, told apart by their access token"""
+    def __init__(self, displays):
+        self.displays = displays    # token key -> list of displays
+        self.calls = []
+
+    def request(self, url, body=None, timeout=None):
+        params = dict(cgi.parse_qsl(str(body)))
+        method = url.rstrip('/').split('/')[-1]
+        org = params['oauth_token']
+        if org == 'broken':
+            raise urllib2.URLError("Simulated failure")
+        if method == 'getDisplays':
+            response = self.displays[org]
+        else:
+            self.calls.append((org, method, params))
+            response = None
+        return json.dumps({'result': 'OK', 'response': response})
+
+class FanOutTestCase(unittest.TestCase):
+
+    def testFanOut(self):
+        fleet = FleetTransport({
+            'a': [{'display_uuid': 'a1', 'tags': ['lobby']}, {'display_uuid': 'a2', 'tags': []}],
+            'b': [{'display_uuid': 'b1', 'tags': ['lobby', 'x']}, {'display_uuid': 'b2', 'tags': ['lobby']}],
+            'c': [],
+        })
+        server = api.CodaServer(TEST_KEY, TEST_SECRET, transport=fleet)
+        tokens = ["oauth_token_secret=s&oauth_token=%s" % t for t in ['a', 'b', 'c', 'broken']]
+        cache = fanout.DisplayCache()
+        results = fanout.fan_out(server, tokens, 'lobby', source_uuid='s1', cache=cache)
+        self.assertEqual([r.ok for r in results], [True, True, True, False])
+        self.assertEqual(results[1].display_uuids, ['b1', 'b2'])
+        self.assertEqual(sorted([(org, json.loads(p['display_uuids'])) for org, m, p in fleet.calls]),
+                         [('a', ['a1']), ('b', ['b1', 'b2'])])
+        self.assertTrue(isinstance(results[3].error, urllib2.URLError))
+
+        # Second time round, the displays come from the cache, and a call
+        # without a display list is made for each display.
+        fleet.calls = []
+        results = fanout.fan_out(server, tokens[:2], ['lobby', 'x'], 'modifyDisplay',
+                                 cache=cache, tags=['lobby'])
+        self.assertTrue(results[0].cached)
+        self.assertEqual([(org, p['display_uuid']) for org, m, p in fleet.calls], [('b', 'b1')])
+
+class AuthTransport(object):
+    """Hands out request tokens, and access tokens for those which have been approved"""
+    def __init__(self):
+        self.approved = set()
+        self.unreachable = set()    # request tokens for which the network fails
+        self.failures = 0           # number of request tokens to fail to get
+
+    def request(self, url, body=None, timeout=None):
+        params = dict(cgi.parse_qsl(url.split('?')[1]))
+        if params.get('oauth_token') in self.unreachable:
+            raise urllib2.URLError("Simulated failure")
+        if '/request_token/' in url:
+            if self.failures:
+                self.failures -= 1
+                raise socket.timeout("timed out")
+            return "oauth_token_secret=s&oauth_token=r%s" % params['oauth_nonce']
+        if params['oauth_token'] not in self.approved:
+            raise urllib2.HTTPError(url, 401, "Unauthorized", {}, None)
+        return "oauth_token_secret=s&oauth_token=a%s" % params['oauth_token']
+
+class TokenStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tokens.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testHotReload(self):
+        writer = tokenstore.TokenStore(self.path)
+        reader = tokenstore.TokenStore(self.path, check_interval=0)
+        writer.put_many([('acme', 'tok1'), ('widgets', 'tok2')])
+        self.assertEqual(reader['acme'], 'tok1')
+        writer.put('acme', 'tok3')
+        writer.remove('widgets')
+        self.assertEqual(reader['acme'], 'tok3')
+        self.assertFalse('widgets' in reader)
+        self.assertEqual(reader.names(), ['acme'])
+
+    def testBulkAuth(self):
+        auth = AuthTransport()
+        server = api.CodaServer(TEST_KEY, TEST_SECRET, transport=auth)
+        store = tokenstore.TokenStore(self.path)
+        urls, failures = store.request_auth(server, ['u1', 'u2'])
+        self.assertEqual([name for name, url in urls], ['u1', 'u2'])
+        self.assertEqual(failures, {})
+        # Only u1 approves
+        u1_token = cgi.parse_qs(urls[0][1].split('?')[1])['oauth_token'][0]
+        auth.approved.add(u1_token)
+        failures = store.complete_auth(server)
+        self.assertEqual(failures.keys(), ['u2'])
+        self.assertEqual(store['u1'], "oauth_token_secret=s&oauth_token=a%s" % u1_token)
+        self.assertFalse('u2' in store)
+
+    def testNetworkErrors(self):
+        auth = AuthTransport()
+        auth.failures = 1
+        server = api.CodaServer(TEST_KEY, TEST_SECRET, transport=auth)
+        store = tokenstore.TokenStore(self.path)
+        urls, failures = store.request_auth(server, ['u1', 'u2', 'u3'])
+        self.assertEqual(len(urls), 2)
+        self.assertTrue(isinstance(failures.values()[0], socket.timeout))
+        # Everyone approves, but the network fails when fetching the first
+        # user's access token
+        tokens = [cgi.parse_qs(url.split('?')[1])['oauth_token'][0] for name, url in urls]
+        auth.approved.update(tokens)
+        auth.unreachable.add(tokens[0])
+        failures = store.complete_auth(server)
+        self.assertEqual(failures.keys(), [urls[0][0]])
+        self.assertTrue(isinstance(failures[urls[0][0]], urllib2.URLError))
+        self.assertEqual(store.names(), [urls[1][0]])
+        # It's still pending, so can be tried again
+        auth.unreachable.clear()
+        self.assertEqual(store.complete_auth(server), {})
+        self.assertEqual(store.names(), sorted([name for name, url in urls]))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,113 @@
+#
+# Making the same change across many organisations at once.
+#
+# fan_out() takes a list of access tokens, one per organisation, finds the
+# displays in each with the given tags, and makes a call for them - by
+# default assignSource - working on several organisations at the same time:
+#
+#     results = fanout.fan_out(s, tokens, 'lobby', source_uuid=su)
+#     for r in results:
+#         if not r.ok:
+#             print "Failed for %s: %s" % (r.token, r.error)
+#
+# Calls which take a list of display_uuids (like assignSource) are made once
+# per organisation; others (like modifyDisplay) once per matching display.
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import threading
+import time
+import api
+import pool
+
+class DisplayCache(object):
+    """Remembers each organisation's displays for 'ttl' seconds"""
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.entries = {}   # token -> (time, displays)
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(token)
+            if entry and time.time() - entry[0] < self.ttl:
+                return entry[1]
+            return None
+        finally:
+            self.lock.release()
+
+    def put(self, token, displays):
+        self.lock.acquire()
+        try:
+            self.entries[token] = (time.time(), displays)
+        finally:
+            self.lock.release()
+
+class FanOutResult(object):
+    def __init__(self, token):
+        self.token = token
+        self.ok = False
+        self.display_uuids = []     # the displays which matched
+        self.response = None        # from the call, or a list of them if one per display
+        self.error = None           # the exception, if it failed
+        self.cached = False         # whether the displays came from the cache
+        self.timings = {}           # seconds spent on 'resolve', 'apply' and 'total'
+
+    def __repr__(self):
+        return "<FanOutResult %s: %d displays in %.2fs>" % (
+            self.ok and 'OK' or 'failed: %s' % self.error,
+            len(self.display_uuids), self.timings.get('total', 0))
+
+def matcher(selector):
+    """
+    Turn a selector into a function which tests a display.  The selector can
+    be a tag, a list of tags (all of which must be present), or a function.
+    """
+    if callable(selector):
+        return selector
+    if isinstance(selector, basestring):
+        selector = [selector]
+    tags = set(selector)
+    return lambda display: tags.issubset(display.get('tags') or [])
+
+def fan_out(server, tokens, selector, method='assignSource', workers=8, cache=None, **kwargs):
+    """
+    For each access token, find the displays matching 'selector' and make
+    the 'method' call for them, with the other kwargs as parameters.
+    Up to 'workers' organisations are dealt with at the same time.  Display
+    lists are taken from 'cache' (a DisplayCache) when they're fresh enough.
+    Returns a FanOutResult for each token, in the same order.
+    """
+    matches = matcher(selector)
+    per_display = api.LIST_PARAMS.get(method) != 'display_uuids'
+
+    def run(token):
+        result = FanOutResult(token)
+        start = time.time()
+        try:
+            coda = server.get_coda(token)
+            displays = cache and cache.get(token)
+            result.cached = displays is not None
+            if displays is None:
+                displays = coda.getDisplays()
+                if cache:
+                    cache.put(token, displays)
+            result.display_uuids = [d['display_uuid'] for d in displays if matches(d)]
+            resolved = time.time()
+            result.timings['resolve'] = resolved - start
+            if per_display:
+                result.response = [coda.callMethod(method, display_uuid=du, **kwargs)
+                                   for du in result.display_uuids]
+            elif result.display_uuids:
+                result.response = coda.callMethod(method, display_uuids=result.display_uuids,
+                                                  **kwargs)
+            result.timings['apply'] = time.time() - resolved
+            result.ok = True
+        except Exception, e:
+            result.error = e
+        result.timings['total'] = time.time() - start
+        return result
+
+    return list(pool.imap_ordered(run, tokens, workers))
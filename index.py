@@ -0,0 +1,160 @@
+#
+# A local search index over records from getSources() or getDisplays().
+#
+# Rather than asking the server to search by name on every keystroke, build
+# an index from a snapshot of the records and search that:
+#
+#     idx = index.RecordIndex(c.getSources())
+#     idx.search(name='nasa')
+#     idx.search(tags=['lobby'], type_uuid=tu)
+#
+# Keep it up to date by feeding it the Deltas from a watcher.Watcher:
+#
+#     w = watcher.Watcher.for_coda(c, 'getSources')
+#     w.subscribe(idx.apply)
+#
+# Names are searched case-insensitively for a substring, using an index of
+# the one, two and three-letter sequences ('n-grams') in each name, so that
+# queries of up to three letters - the first keystrokes of a type-ahead - are
+# a single lookup.  For those, pass a limit to get just the first few matches:
+#
+#     idx.search(name='n', limit=20)
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import threading
+
+def trigrams(text):
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+def ngrams(text):
+    """Every sequence of one, two or three letters in the text"""
+    return set([text[i:i + n] for n in (1, 2, 3) for i in range(len(text) - n + 1)])
+
+class RecordIndex(object):
+    def __init__(self, records=(), id_field='source_uuid'):
+        self.id_field = id_field
+        self.records = {}       # seq -> record
+        self.seqs = {}          # record id -> seq
+        self.names = {}         # seq -> lower case name
+        self.grams = {}         # n-gram -> set of seqs
+        self.tags = {}          # tag -> set of seqs
+        self.types = {}         # type_uuid -> set of seqs
+        self.next_seq = 0
+        self.lock = threading.RLock()
+        for r in records:
+            self.add(r)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _postings(self, seq, record):
+        """The (index, key) pairs under which a record is filed"""
+        name = self.names[seq]
+        result = [(self.grams, g) for g in ngrams(name)]
+        result.extend([(self.tags, t) for t in record.get('tags') or []])
+        if 'type_uuid' in record:
+            result.append((self.types, record['type_uuid']))
+        return result
+
+    def add(self, record):
+        """Add a record, or replace the one with the same id"""
+        self.lock.acquire()
+        try:
+            uuid = record[self.id_field]
+            if uuid in self.seqs:
+                seq = self.seqs[uuid]
+                self._unfile(seq)
+            else:
+                seq = self.seqs[uuid] = self.next_seq
+                self.next_seq += 1
+            self.records[seq] = record
+            self.names[seq] = (record.get('name') or '').lower()
+            for idx, key in self._postings(seq, record):
+                idx.setdefault(key, set()).add(seq)
+        finally:
+            self.lock.release()
+
+    def _unfile(self, seq):
+        for idx, key in self._postings(seq, self.records[seq]):
+            seqs = idx.get(key)
+            if seqs is not None:
+                seqs.discard(seq)
+                if not seqs:
+                    del idx[key]
+
+    def remove(self, uuid):
+        """Remove the record with this id, if there is one"""
+        self.lock.acquire()
+        try:
+            if uuid in self.seqs:
+                seq = self.seqs.pop(uuid)
+                self._unfile(seq)
+                del self.records[seq]
+                del self.names[seq]
+        finally:
+            self.lock.release()
+
+    def apply(self, delta):
+        """Bring the index up to date with a watcher.Delta"""
+        self.lock.acquire()
+        try:
+            for r in delta.removed:
+                self.remove(r[self.id_field])
+            for r in delta.added + delta.changed:
+                self.add(r)
+        finally:
+            self.lock.release()
+
+    def _name_matches(self, name):
+        name = name.lower()
+        if len(name) <= 3:
+            return self.grams.get(name, frozenset())
+        sets = [self.grams.get(g, frozenset()) for g in trigrams(name)]
+        sets.sort(key=len)
+        candidates = sets[0].intersection(*sets[1:])
+        names = self.names
+        return set([seq for seq in candidates if name in names[seq]])
+
+    def search(self, name=None, tags=None, type_uuid=None, limit=None):
+        """
+        Return the records whose names contain 'name', which have all of the
+        given tags and the given type_uuid, in the order they were added.
+        With a limit, return only the first 'limit' of them.
+        """
+        self.lock.acquire()
+        try:
+            sets = []
+            if tags:
+                sets.extend([self.tags.get(t, set()) for t in tags])
+            if type_uuid is not None:
+                sets.append(self.types.get(type_uuid, set()))
+            if sets:
+                sets.sort(key=len)
+                found = sets[0].intersection(*sets[1:])
+                if name and len(found) < len(self.records) / 20:
+                    # Quicker to check the few we've got than use the n-grams
+                    name = name.lower()
+                    names = self.names
+                    found = set([seq for seq in found if name in names[seq]])
+                elif name:
+                    found &= self._name_matches(name)
+            elif name:
+                found = self._name_matches(name)
+            else:
+                found = self.records
+            if limit and found and limit * self.next_seq < len(found) ** 2:
+                # Lots of matches: quicker to go through the records in
+                # order until we have enough than to sort them all.
+                seqs = []
+                for seq in xrange(self.next_seq):
+                    if seq in found:
+                        seqs.append(seq)
+                        if len(seqs) == limit:
+                            break
+            else:
+                seqs = sorted(found)[:limit]
+            return [self.records[seq] for seq in seqs]
+        finally:
+            self.lock.release()
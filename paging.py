@@ -0,0 +1,95 @@
+#
+# Chunked fetching of large record lists from the CODA API.
+#
+# Calls like getSources() return everything in the organisation in one
+# response, which can be slow and memory-hungry for big organisations.
+# A PagedFetch gets the list of UUIDs once and then fetches the full records
+# a chunk at a time, optionally several chunks at once:
+#
+#     fetch = c.iter_records('getSources', chunk_size=200, workers=4)
+#     for src in fetch:
+#         ...
+#
+# If the export fails part way through, save fetch.uuids and fetch.cursor
+# and pass them back in to carry on from where it left off:
+#
+#     fetch = c.iter_records('getSources', uuids=saved_uuids, cursor=saved_cursor)
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import httplib
+import time
+import urllib2
+import api
+import pool
+
+def should_retry(e):
+    """
+    Whether a chunk which failed with this exception is worth trying again:
+    network errors and timeouts, and errors on the server's side, are; the
+    server rejecting the call, or an open circuit breaker, aren't.
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code >= 500
+    return isinstance(e, (IOError, httplib.HTTPException))
+
+class PagedFetch(object):
+    def __init__(self, coda, method, uuids=None, chunk_size=100, workers=1,
+                 retries=3, retry_delay=1.0, cursor=0, **kwargs):
+        """
+        method      - a list call from api.RECORD_METHODS, eg 'getSources'
+        uuids       - the UUIDs to fetch. If not given, they are listed with one
+                      call to 'method', using any extra kwargs as its filter.
+        chunk_size  - number of records to ask for in each call
+        workers     - number of chunks to fetch at the same time
+        retries     - number of times to retry a chunk after a network or server error
+        retry_delay - seconds before the first retry; doubled for each one after
+        cursor      - number of UUIDs already done, to resume an earlier fetch
+        """
+        if method not in api.RECORD_METHODS:
+            raise api.CodaException("Don't know how to page through %s" % method)
+        self.coda = coda
+        self.method = method
+        self.id_field, self.list_param = api.RECORD_METHODS[method]
+        self.uuids = uuids
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.cursor = cursor
+        self.kwargs = kwargs
+
+    def list_uuids(self):
+        if self.uuids is None:
+            records = self.coda.callMethod(self.method, **self.kwargs)
+            self.uuids = [r[self.id_field] for r in records]
+        return self.uuids
+
+    def chunks(self):
+        """Yield (start, uuids) for each chunk still to be fetched"""
+        uuids = self.list_uuids()
+        for start in xrange(self.cursor, len(uuids), self.chunk_size):
+            yield start, uuids[start:start + self.chunk_size]
+
+    def fetch_chunk(self, chunk):
+        start, uuids = chunk
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                params = {self.list_param: uuids}
+                return start + len(uuids), self.coda.callMethod(self.method, **params)
+            except Exception, e:
+                if attempt == self.retries or not should_retry(e):
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def __iter__(self):
+        # The cursor only moves on once a whole chunk has been handed over,
+        # so resuming never skips records, though it may repeat some of a chunk
+        # that was only partly consumed.
+        for end, records in pool.imap_ordered(self.fetch_chunk, self.chunks(), self.workers):
+            for r in records:
+                yield r
+            self.cursor = end
@@ -0,0 +1,106 @@
+#
+# Small thread-pool helpers shared by the pycoda modules which make
+# several API calls at once.
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from collections import deque
+
+log = logging.getLogger('pycoda.pool')
+
+class Future(object):
+    """
+    The eventual result of a call made in the background: a cut-down version
+    of the Future in Python 3's concurrent.futures.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result, or raise its exception"""
+        if not self._event.wait(timeout) and not self.done():
+            raise RuntimeError("Timed out waiting for result")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the call to finish and return its exception, if any"""
+        if not self._event.wait(timeout) and not self.done():
+            raise RuntimeError("Timed out waiting for result")
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when the call finishes, or now if it already has"""
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        self._call(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        # A callback which fails mustn't stop the others, or whoever finished
+        # the call, so its exception is just logged.
+        try:
+            fn(self)
+        except Exception:
+            log.exception("Exception in callback %r for %r", fn, self)
+
+def imap_ordered(func, items, workers=4, window=None, executor=None):
+    """
+    Like itertools.imap(func, items), but runs up to 'workers' calls at once.
+    Results are yielded in the order of 'items', and no more than 'window'
+    (default: twice the number of workers) are ever outstanding, so a slow
+    consumer doesn't cause results to pile up in memory.
+    The calls are made in a new pool of threads, unless an existing pool
+    (eg. a multiprocessing.Pool) is given as 'executor'.
+    """
+    if workers <= 1 and executor is None:
+        for item in items:
+            yield func(item)
+        return
+    window = window or workers * 2
+    pool = executor or ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if executor is None:
+            pool.terminate()
@@ -0,0 +1,122 @@
+#
+# Sampling profiler for the time pycoda spends on each stage of a call.
+#
+# Generic profilers show pycoda's work as a tangle of urllib, hmac and json
+# frames.  A Profiler instead times the stages of each API call itself, for a
+# random sample of calls, and adds them up per method:
+#
+#     s = CodaServer(KEY, SECRET, profiler=profiling.Profiler(sample_rate=0.01))
+#     ...
+#     print s.profiler.table()
+#     s.profiler.dump('pycoda.folded')   # for flamegraph.pl and similar tools
+#
+# The stages are named after the steps the oauth module would go through:
+#
+#   from_consumer_and_token   - setting up the OAuth parameters
+#   get_normalized_parameters - encoding, escaping and sorting the parameters
+#   build_signature           - working out the HMAC signature
+#   to_postdata               - setting up the request body
+#   transport                 - sending the request (including streaming out
+#                               the body) and reading the response
+#   json.loads                - decoding the response
+#
+# Only sampled calls are timed, so with a low sample rate the cost for the
+# others is one random number each.
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import random
+import threading
+import time
+
+STAGES = ('from_consumer_and_token', 'get_normalized_parameters', 'build_signature',
+          'to_postdata', 'transport', 'json.loads')
+
+class Trace(object):
+    """The timings for one sampled call"""
+    def __init__(self, profiler, method):
+        self.profiler = profiler
+        self.method = method
+        self.times = {}
+        self.start = self.last = time.time()
+
+    def mark(self, stage):
+        """Note that 'stage' has just finished"""
+        now = time.time()
+        self.times[stage] = self.times.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        self.profiler.add(self.method, self.times, self.last - self.start)
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.stages = dict([(s, 0.0) for s in STAGES])
+
+class Profiler(object):
+    def __init__(self, sample_rate=0.01):
+        """sample_rate - the fraction of calls to time"""
+        self.sample_rate = sample_rate
+        self.stats = {}     # method -> MethodStats
+        self.lock = threading.Lock()
+
+    def start(self, method):
+        """Return a Trace if this call should be timed, otherwise None"""
+        if random.random() < self.sample_rate:
+            return Trace(self, method.rstrip('/'))
+        return None
+
+    def add(self, method, times, total):
+        self.lock.acquire()
+        try:
+            stats = self.stats.setdefault(method, MethodStats())
+            stats.calls += 1
+            stats.total += total
+            for stage, t in times.items():
+                stats.stages[stage] = stats.stages.get(stage, 0.0) + t
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        self.stats = {}
+        self.lock.release()
+
+    def folded(self):
+        """
+        Lines of 'pycoda;method;stage microseconds', in the 'folded stacks'
+        format used by flame graph tools.  The times are totals for the
+        sampled calls.
+        """
+        lines = []
+        for method, stats in sorted(self.stats.items()):
+            for stage in STAGES:
+                us = int(stats.stages.get(stage, 0.0) * 1e6)
+                if us:
+                    lines.append('pycoda;%s;%s %d' % (method, stage, us))
+        return lines
+
+    def dump(self, path):
+        """Write the folded stacks to a file"""
+        f = open(path, 'w')
+        for line in self.folded():
+            f.write(line + '\n')
+        f.close()
+
+    def table(self):
+        """A printable table of the mean time per call spent in each stage"""
+        header = '%-20s %8s %10s  ' % ('method', 'sampled', 'mean us') + \
+                 '  '.join(['%s' % s for s in STAGES])
+        lines = [header]
+        for method, stats in sorted(self.stats.items()):
+            cells = []
+            for stage in STAGES:
+                t = stats.stages.get(stage, 0.0)
+                cell = '%.0f (%d%%)' % (t / stats.calls * 1e6, 100 * t / max(stats.total, 1e-9))
+                cells.append(cell.rjust(len(stage)))
+            lines.append('%-20s %8d %10.0f  ' % (method, stats.calls, stats.total / stats.calls * 1e6)
+                         + '  '.join(cells))
+        return '\n'.join(lines)
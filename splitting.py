@@ -0,0 +1,142 @@
+#
+# Automatic splitting of calls with very long lists of UUIDs.
+#
+# Calls like assignSource(display_uuids=[...]) and getSources(source_uuids=[...])
+# get slow, or too big for the server, when the list is very long.  Coda
+# (and PreparedCall) passes such calls to a Splitter, which breaks the list
+# into chunks, makes a call for each chunk (several at once), and puts the
+# responses back together in the original order, so the caller sees a single
+# call.  How the responses are put together depends on the method - see MERGE.
+#
+# The chunk size for each method adapts to how long the chunks take: it grows
+# while they are quick, and shrinks if they take longer than target_latency.
+#
+#     print c.splitter.metrics()
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import threading
+import time
+import pool
+
+def join_lists(method, results):
+    """The list calls: join the lists together"""
+    merged = []
+    for r in results:
+        if not isinstance(r, list):
+            raise merge_error(method, results)
+        merged.extend(r)
+    return merged
+
+def same_response(method, results):
+    """Calls which make a change: every chunk should have said the same thing"""
+    for r in results[1:]:
+        if r != results[0]:
+            raise merge_error(method, results)
+    return results[0]
+
+def merge_error(method, results):
+    import api
+    return api.CodaException("Can't combine the responses to the %d parts of a split %s call"
+                             % (len(results), method))
+
+# How to merge the responses to the chunks of a split call, for each method
+# in api.LIST_PARAMS.  Methods not listed here get same_response.
+MERGE = {
+    'getSources':   join_lists,
+    'getDisplays':  join_lists,
+    'getUsers':     join_lists,
+    'assignSource': same_response,
+}
+
+class ChunkSizer(object):
+    """The adaptive chunk size and statistics for one method"""
+    def __init__(self, size):
+        self.size = size
+        self.split_calls = 0
+        self.chunks = 0
+        self.mean_latency = None
+
+    def as_dict(self):
+        return {
+            'chunk_size': self.size,
+            'split_calls': self.split_calls,
+            'chunks': self.chunks,
+            'mean_latency': self.mean_latency,
+        }
+
+class Splitter(object):
+    def __init__(self, chunk_size=500, min_size=50, max_size=5000, target_latency=2.0,
+                 workers=4):
+        """
+        chunk_size     - starting size of chunks, and so the longest list sent unsplit
+        min_size       - never make chunks smaller than this
+        max_size       - or bigger than this
+        target_latency - seconds a chunk should take at most
+        workers        - number of chunks to send at the same time
+        """
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.workers = workers
+        self.sizers = {}
+        self.lock = threading.Lock()
+
+    def sizer(self, method):
+        self.lock.acquire()
+        try:
+            if method not in self.sizers:
+                self.sizers[method] = ChunkSizer(self.chunk_size)
+            return self.sizers[method]
+        finally:
+            self.lock.release()
+
+    def should_split(self, method, values):
+        return isinstance(values, list) and len(values) > self.sizer(method).size
+
+    def record(self, sizer, latency):
+        """Adjust the chunk size after a chunk took 'latency' seconds"""
+        self.lock.acquire()
+        try:
+            sizer.chunks += 1
+            if sizer.mean_latency is None:
+                sizer.mean_latency = latency
+            else:
+                sizer.mean_latency = 0.8 * sizer.mean_latency + 0.2 * latency
+            if latency > self.target_latency:
+                sizer.size = max(self.min_size, sizer.size // 2)
+            elif latency < self.target_latency / 2.0:
+                sizer.size = min(self.max_size, int(sizer.size * 1.25) + 1)
+        finally:
+            self.lock.release()
+
+    def call(self, send, method, param, kwargs):
+        """
+        Make the call in chunks of kwargs[param], using send(params) to make
+        the call for each chunk, and merge the responses as MERGE says.
+        If a chunk fails its exception is raised, though other chunks may
+        already have taken effect; the same goes for the CodaException
+        raised if the responses can't be merged.
+        """
+        sizer = self.sizer(method)
+        values = kwargs[param]
+        size = sizer.size
+        chunks = [values[i:i + size] for i in xrange(0, len(values), size)]
+        sizer.split_calls += 1
+
+        def call_chunk(chunk):
+            params = dict(kwargs)
+            params[param] = chunk
+            start = time.time()
+            result = send(params)
+            self.record(sizer, time.time() - start)
+            return result
+
+        results = list(pool.imap_ordered(call_chunk, chunks, self.workers))
+        return MERGE.get(method, same_response)(method, results)
+
+    def metrics(self):
+        """The chunk size and statistics for each method that has been split"""
+        return dict([(method, s.as_dict()) for method, s in self.sizers.items()])
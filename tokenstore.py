@@ -0,0 +1,232 @@
+#
+# A store for access tokens, for applications which act for many users.
+#
+# Tokens are kept in an SQLite database file, looked up by whatever name the
+# application uses for the user or organisation, and cached in memory.  If
+# another process (or another program) changes the file, the cache is thrown
+# away, so changes show up without restarting anything.
+#
+#     store = tokenstore.TokenStore('tokens.db')
+#     store.put('acme', atok)
+#     c = store.get_coda(s, 'acme')
+#
+# To get tokens for lots of users at once, first ask for the authorisation
+# URLs, send each user theirs, and then once they've approved, collect the
+# access tokens:
+#
+#     urls, failures = store.request_auth(s, names)
+#     for name, url in urls:
+#         send_to_user(name, url)
+#     ...
+#     failures = store.complete_auth(s)
+#
+# Each token is stored as soon as it arrives, so one user's failure (even a
+# network error) doesn't lose anyone else's.
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import httplib
+import os
+import sqlite3
+import threading
+import time
+import api
+import pool
+
+# The server turning a request down, or the network failing
+AUTH_ERRORS = (api.CodaException, IOError, httplib.HTTPException)
+
+class TokenStore(object):
+    def __init__(self, path, check_interval=1.0):
+        """
+        path           - the database file, which is created if needed
+        check_interval - how often, in seconds, to check for changes by others
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.connect()
+
+    def connect(self):
+        self.lock.acquire()
+        try:
+            # Several processes can use the file at once; writers wait their turn.
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tokens "
+                            "(name TEXT PRIMARY KEY, token TEXT NOT NULL, updated REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS pending "
+                            "(name TEXT PRIMARY KEY, request_token TEXT NOT NULL, updated REAL)")
+            self.db.commit()
+            self.pid = os.getpid()
+            self.inode = os.stat(self.path).st_ino
+            self.version = self.data_version()
+            self.last_check = time.time()
+            self.cache = {}
+        finally:
+            self.lock.release()
+
+    def data_version(self):
+        """A number which changes whenever another connection changes the database"""
+        row = self.db.execute("PRAGMA data_version").fetchone()
+        if row is None:
+            # SQLite before 3.8.8: go by the files' modification times instead
+            return tuple([os.path.getmtime(p) for p in (self.path, self.path + '-wal')
+                          if os.path.exists(p)])
+        return row[0]
+
+    def check(self):
+        """Throw away the cache if the database has changed"""
+        now = time.time()
+        if now - self.last_check < self.check_interval and os.getpid() == self.pid:
+            return
+        self.lock.acquire()
+        try:
+            self.last_check = now
+            try:
+                inode = os.stat(self.path).st_ino
+            except OSError:
+                inode = None
+            if os.getpid() != self.pid or inode != self.inode:
+                # We've been forked, or the file has been replaced
+                self.connect()
+            else:
+                version = self.data_version()
+                if version != self.version:
+                    self.version = version
+                    self.cache = {}
+        finally:
+            self.lock.release()
+
+    def get(self, name, default=None):
+        """Return the access token string for 'name'"""
+        self.check()
+        token = self.cache.get(name)
+        if token is None:
+            self.lock.acquire()
+            try:
+                row = self.db.execute("SELECT token FROM tokens WHERE name = ?", (name,)).fetchone()
+            finally:
+                self.lock.release()
+            if row is None:
+                return default
+            token = self.cache[name] = str(row[0])
+        return token
+
+    def __getitem__(self, name):
+        token = self.get(name)
+        if token is None:
+            raise KeyError(name)
+        return token
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def put(self, name, token):
+        self.put_many([(name, token)])
+
+    def put_many(self, items):
+        """Store a list of (name, token) pairs in one go"""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO tokens (name, token, updated) VALUES (?, ?, ?)",
+                                [(name, token, now) for name, token in items])
+            self.db.commit()
+            for name, token in items:
+                self.cache[name] = token
+        finally:
+            self.lock.release()
+
+    def remove(self, name):
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM tokens WHERE name = ?", (name,))
+            self.db.commit()
+            self.cache.pop(name, None)
+        finally:
+            self.lock.release()
+
+    def names(self):
+        self.lock.acquire()
+        try:
+            return [str(r[0]) for r in self.db.execute("SELECT name FROM tokens ORDER BY name")]
+        finally:
+            self.lock.release()
+
+    def get_coda(self, server, name):
+        """Return a Coda object from 'server' using the token stored for 'name'"""
+        return server.get_coda(self[name])
+
+    def request_auth(self, server, names, workers=4):
+        """
+        Start getting access tokens for several users.  Returns a list of
+        (name, url) pairs: each user needs to visit their URL to approve the
+        request, after which complete_auth will fetch their access token.
+        Also returns a dict of the names which failed, with the exception for
+        each, which can be tried again.
+        """
+        def fetch(name):
+            try:
+                return name, server.get_auth(), None
+            except AUTH_ERRORS, e:
+                return name, None, e
+
+        urls, failures = [], {}
+        for name, auth, error in pool.imap_ordered(fetch, names, workers):
+            if error:
+                failures[name] = error
+                continue
+            rtok, url = auth
+            self.lock.acquire()
+            try:
+                self.db.execute("INSERT OR REPLACE INTO pending (name, request_token, updated) "
+                                "VALUES (?, ?, ?)", (name, rtok, time.time()))
+                self.db.commit()
+            finally:
+                self.lock.release()
+            urls.append((name, url))
+        return urls, failures
+
+    def complete_auth(self, server, names=None, workers=4):
+        """
+        Fetch and store the access tokens for users from request_auth (by
+        default, all of them who haven't been done yet).  Returns a dict of
+        the names which failed, with the exception for each; they can be
+        tried again later, eg. if the user hasn't approved the request yet.
+        """
+        self.lock.acquire()
+        try:
+            pending = [(str(n), str(t)) for n, t in
+                       self.db.execute("SELECT name, request_token FROM pending")]
+        finally:
+            self.lock.release()
+        if names is not None:
+            names = set(names)
+            pending = [(n, t) for n, t in pending if n in names]
+
+        def fetch(item):
+            try:
+                return item[0], server.get_access_token(item[1]), None
+            except AUTH_ERRORS, e:
+                return item[0], None, e
+
+        failures = {}
+        for name, token, error in pool.imap_ordered(fetch, pending, workers):
+            if error:
+                failures[name] = error
+                continue
+            # The request token has been used up, so store the access token
+            # straight away rather than risk losing it.
+            self.lock.acquire()
+            try:
+                self.put(name, token)
+                self.db.execute("DELETE FROM pending WHERE name = ?", (name,))
+                self.db.commit()
+            finally:
+                self.lock.release()
+        return failures
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,300 @@
+#
+# Transports: the layer which actually sends pycoda's requests to the server.
+#
+# The default, UrllibTransport, uses urllib2.  The others let you record the
+# requests and responses of a real session in a 'cassette' file, and then
+# play them back later without touching the network, which is handy for
+# tests and for load generation:
+#
+#     s = CodaServer(KEY, SECRET, transport=transport.RecordingTransport('session.cassette'))
+#     ... use s as normal ...
+#
+#     s = CodaServer(KEY, SECRET, transport=transport.ReplayTransport('session.cassette'))
+#     ... the same calls now get the recorded responses ...
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import cgi
+import httplib
+import socket
+import threading
+import time
+import urllib2
+
+# Find a simplejson library somewhere!
+try:
+    import json  # Python 2.6 onwards
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        "Please install the simplejson module or update to a Python version which includes json"
+
+# These change on every request, so are ignored when matching them up
+VOLATILE_PARAMS = ('oauth_nonce', 'oauth_timestamp', 'oauth_signature')
+
+class CassetteError(LookupError):
+    """A request being replayed isn't in the cassette"""
+
+# Failures other than HTTP errors which are recorded in cassettes, and raised
+# again on replay, by name.  More specific ones come first.
+RECORDED_ERRORS = [
+    ('timeout', socket.timeout),
+    ('socket.error', socket.error),
+    ('URLError', urllib2.URLError),
+    ('BadStatusLine', httplib.BadStatusLine),
+    ('IncompleteRead', httplib.IncompleteRead),
+    ('HTTPException', httplib.HTTPException),
+]
+
+# urllib2 only has one timeout, which it uses both for connecting and for
+# each read.  These connection classes switch to a separate read timeout
+# once they're connected.
+
+class _HTTPConnection(httplib.HTTPConnection):
+    read_timeout = None
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        if self.read_timeout is not None:
+            self.sock.settimeout(self.read_timeout)
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    read_timeout = None
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        if self.read_timeout is not None:
+            self.sock.settimeout(self.read_timeout)
+
+def _connection_class(cls, read_timeout):
+    def make(host, **kwargs):
+        conn = cls(host, **kwargs)
+        conn.read_timeout = read_timeout
+        return conn
+    return make
+
+class _HTTPHandler(urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_connection_class(_HTTPConnection, req.read_timeout), req)
+
+class _HTTPSHandler(urllib2.HTTPSHandler):
+    def https_open(self, req):
+        kwargs = {}
+        if hasattr(self, '_context'): # Python 2.7.9 onwards
+            kwargs['context'] = self._context
+        return self.do_open(_connection_class(_HTTPSConnection, req.read_timeout), req, **kwargs)
+
+def split_timeout(timeout):
+    """Turn a timeout, or a (connect, read) pair of them, into a pair"""
+    if isinstance(timeout, (tuple, list)):
+        return timeout
+    return timeout, timeout
+
+class UrllibTransport(object):
+    def __init__(self, timeout=None):
+        """
+        timeout - default timeout in seconds for requests, or a (connect, read)
+                  pair of timeouts. None means wait as long as it takes.
+        """
+        self.timeout = timeout
+        self.opener = urllib2.build_opener(_HTTPHandler, _HTTPSHandler)
+
+    def request(self, url, body=None, timeout=None):
+        """
+        Send a request - a POST if there's a body, otherwise a GET - and return
+        the data in the response.  Raises urllib2.HTTPError for HTTP errors,
+        and urllib2.URLError or socket.timeout if it takes too long.
+        """
+        connect_timeout, read_timeout = split_timeout(timeout or self.timeout)
+        req = urllib2.Request(url, body)
+        req.read_timeout = read_timeout
+        if connect_timeout is None:
+            connect_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        response = self.opener.open(req, timeout=connect_timeout)
+        return response.read()
+
+def request_key(url, body):
+    """Something to match up equivalent requests by"""
+    if body is None:
+        url, _, body = url.partition('?')
+    params = [(k, v) for k, v in cgi.parse_qsl(str(body), keep_blank_values=True)
+              if k not in VOLATILE_PARAMS]
+    params.sort()
+    return json.dumps([url, params])
+
+class RecordingTransport(object):
+    """Passes requests on to another transport, and records them in a cassette file"""
+    def __init__(self, path, transport=None):
+        self.transport = transport or UrllibTransport()
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def request(self, url, body=None, timeout=None):
+        entry = {'key': request_key(url, body)}
+        start = time.time()
+        try:
+            try:
+                entry['response'] = self.transport.request(url, body, timeout)
+                return entry['response']
+            except urllib2.HTTPError, e:
+                entry['error'] = [e.code, e.msg]
+                raise
+            except Exception, e:
+                for name, cls in RECORDED_ERRORS:
+                    if isinstance(e, cls):
+                        entry['error_type'] = name
+                        entry['message'] = str(isinstance(e, urllib2.URLError) and e.reason or e)
+                        break
+                else:
+                    # Not something a transport fails with, so nothing to record
+                    entry = None
+                raise
+        finally:
+            if entry is not None:
+                entry['elapsed'] = time.time() - start
+                self.lock.acquire()
+                try:
+                    self.file.write(json.dumps(entry) + '\n')
+                    self.file.flush()
+                finally:
+                    self.lock.release()
+
+    def close(self):
+        self.file.close()
+
+class ReplayTransport(object):
+    """
+    Answers requests from a cassette file, without using the network.
+    If the same request was recorded more than once, the responses are given
+    in the order they were recorded, going back to the first one when they run out.
+    With realtime=True, each response takes as long as it originally did.
+    """
+    def __init__(self, path, realtime=False):
+        self.realtime = realtime
+        self.entries = []
+        self.responses = {}     # request key -> [entries]
+        self.next = {}          # request key -> index of next entry to use
+        self.lock = threading.Lock()
+        f = open(path, 'r')
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                self.entries.append(entry)
+                self.responses.setdefault(entry['key'], []).append(entry)
+        f.close()
+
+    def requests(self):
+        """Return the (url, parameters) of each recorded request, in order"""
+        result = []
+        for entry in self.entries:
+            url, params = json.loads(entry['key'])
+            result.append((url, dict(params)))
+        return result
+
+    def request(self, url, body=None, timeout=None):
+        key = request_key(url, body)
+        self.lock.acquire()
+        try:
+            if key not in self.responses:
+                raise CassetteError("No recorded response for %s" % key)
+            entries = self.responses[key]
+            i = self.next.get(key, 0)
+            self.next[key] = (i + 1) % len(entries)
+            entry = entries[i]
+        finally:
+            self.lock.release()
+        if self.realtime:
+            time.sleep(entry['elapsed'])
+        if 'error' in entry:
+            raise urllib2.HTTPError(url, entry['error'][0], entry['error'][1], {}, None)
+        if 'error_type' in entry:
+            raise dict(RECORDED_ERRORS)[entry['error_type']](entry['message'])
+        return entry['response']
+
+class TimingTransport(object):
+    """
+    Passes requests on to another transport, timing how long they take.
+    Requests made at the same time (eg. the chunks of a split call, from
+    any thread) are only counted once.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.total = 0.0
+        self.active = 0
+        self.busy_since = None
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        """Total time for which at least one request has been in progress"""
+        return self.total
+
+    def request(self, url, body=None, timeout=None):
+        self.lock.acquire()
+        if not self.active:
+            self.busy_since = time.time()
+        self.active += 1
+        self.lock.release()
+        try:
+            return self.transport.request(url, body, timeout)
+        finally:
+            self.lock.acquire()
+            self.active -= 1
+            if not self.active:
+                self.total += time.time() - self.busy_since
+            self.lock.release()
+
+def generate_load(coda, path, threads=4, repeat=1, realtime=False):
+    """
+    Replay the API calls recorded in a cassette from several threads at
+    once, 'repeat' times over in each thread, using a copy of 'coda' for each
+    thread.  Returns a dict of statistics, which separates the time spent in
+    the client itself from the time spent in the (replayed) network transport.
+    """
+    import api
+    replay = ReplayTransport(path, realtime)
+    calls = []
+    for url, params in replay.requests():
+        if url.startswith(coda.api_url):
+            method = url[len(coda.api_url):]
+            calls.append((method, dict([(k, v) for k, v in params.items()
+                                        if not k.startswith('oauth_')])))
+    token = coda.access_token.to_string()
+    stats = {'calls': 0, 'errors': 0, 'total_time': 0.0, 'transport_time': 0.0}
+    lock = threading.Lock()
+
+    def worker():
+        # Each thread's calls go through a transport of their own, so its
+        # transport time includes any chunks sent from the splitter's threads.
+        timing = TimingTransport(replay)
+        client = api.Coda(token, coda.api_url, coda.consumer, timing, coda.timeout,
+                          profiler=coda.profiler)
+        calls_made, errors, total = 0, 0, 0.0
+        for i in range(repeat):
+            for method, params in calls:
+                start = time.time()
+                try:
+                    client.callMethod(method, **params)
+                except Exception:
+                    errors += 1
+                total += time.time() - start
+                calls_made += 1
+        lock.acquire()
+        stats['calls'] += calls_made
+        stats['errors'] += errors
+        stats['total_time'] += total
+        stats['transport_time'] += timing.elapsed()
+        lock.release()
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    stats['wall_time'] = time.time() - start
+    n = max(stats['calls'], 1)
+    stats['calls_per_sec'] = stats['calls'] / max(stats['wall_time'], 1e-9)
+    stats['mean_call'] = stats['total_time'] / n
+    stats['mean_transport'] = stats['transport_time'] / n
+    stats['mean_client'] = (stats['total_time'] - stats['transport_time']) / n
+    return stats
@@ -0,0 +1,222 @@
+#
+# Watching for changes to displays (or other records) in an organisation.
+#
+# A Watcher polls a list call such as getDisplays() in a background thread
+# and tells its subscribers about the records which were added, changed or
+# removed since the last poll.  It polls more often straight after a change
+# and backs off while nothing is happening.
+#
+# Use Watcher.for_coda() to share one poller between all the subscribers
+# interested in the same organisation:
+#
+#     w = watcher.Watcher.for_coda(c)
+#     w.subscribe(lambda delta: sys.stdout.write("%s\n" % delta))
+#
+#     for delta in watcher.Watcher.for_coda(c).deltas():
+#         for d in delta.changed: ...
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import threading
+import Queue
+import api
+
+# Find a simplejson library somewhere!
+try:
+    import json  # Python 2.6 onwards
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        "Please install the simplejson module or update to a Python version which includes json"
+
+def record_hash(record):
+    return hash(json.dumps(record, sort_keys=True))
+
+class Delta(object):
+    """The differences between two successive polls"""
+    def __init__(self, added, changed, removed, records):
+        self.added = added      # records which weren't there before
+        self.changed = changed  # records which are different from before
+        self.removed = removed  # records (as they were) which have gone
+        self.records = records  # the complete new list
+
+    def __nonzero__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return "<Delta: %d added, %d changed, %d removed>" % (
+            len(self.added), len(self.changed), len(self.removed))
+
+class Subscription(object):
+    def __init__(self, watcher, callback, errback=None):
+        self.watcher = watcher
+        self.callback = callback
+        self.errback = errback
+
+    def cancel(self):
+        self.watcher.unsubscribe(self)
+
+class Watcher(object):
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, coda, method='getDisplays', min_interval=2.0, max_interval=60.0,
+                 backoff=1.5, **kwargs):
+        """
+        coda         - the Coda object to poll with
+        method       - a list call from api.RECORD_METHODS
+        min_interval - seconds between polls straight after a change
+        max_interval - the longest we'll wait between polls
+        backoff      - how much the interval grows after each quiet poll
+        Any other kwargs are passed on to the list call.
+        """
+        self.coda = coda
+        self.method = method
+        self.id_field = api.RECORD_METHODS[method][0]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.kwargs = kwargs
+        self.interval = min_interval
+        self.hashes = None      # record id -> hash, from the last poll
+        self.records = {}       # record id -> record, from the last poll
+        self.subscriptions = []
+        # Held while changing the subscriptions or telling them about a
+        # change, so each subscriber sees every change exactly once.
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def for_coda(cls, coda, method='getDisplays', **kwargs):
+        """
+        Return the Watcher shared by everyone polling 'method' in this Coda
+        object's organisation, creating it if needed.  The options only take
+        effect when the watcher is first created.
+        """
+        org = coda.getOrganisation()['organisation_uuid']
+        key = (coda.api_url, org, method)
+        cls._shared_lock.acquire()
+        try:
+            if key not in cls._shared:
+                cls._shared[key] = cls(coda, method, **kwargs)
+            return cls._shared[key]
+        finally:
+            cls._shared_lock.release()
+    for_coda = classmethod(for_coda)
+
+    def diff(self, records):
+        """Compare a new list of records with the last one, and return a Delta"""
+        new_records = {}
+        new_hashes = {}
+        for r in records:
+            new_records[r[self.id_field]] = r
+            new_hashes[r[self.id_field]] = record_hash(r)
+        old_hashes = self.hashes or {}
+        added, changed = [], []
+        for r in records:
+            uuid = r[self.id_field]
+            if uuid not in old_hashes:
+                added.append(r)
+            elif old_hashes[uuid] != new_hashes[uuid]:
+                changed.append(r)
+        removed = [self.records[uuid] for uuid in old_hashes if uuid not in new_hashes]
+        self.records = new_records
+        self.hashes = new_hashes
+        return Delta(added, changed, removed, records)
+
+    def poll(self):
+        """Poll once, notify subscribers of any changes and return the Delta"""
+        records = self.coda.callMethod(self.method, **self.kwargs)
+        self.lock.acquire()
+        try:
+            first = self.hashes is None
+            delta = self.diff(records)
+            if delta and not first:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            if delta:
+                for s in list(self.subscriptions):
+                    # One subscriber's bug shouldn't stop the others hearing about it
+                    try:
+                        s.callback(delta)
+                    except Exception, e:
+                        if s.errback:
+                            s.errback(e)
+        finally:
+            self.lock.release()
+        return delta
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.subscriptions:
+                    # Anyone subscribing after this starts a new thread
+                    self.thread = None
+                    return
+            finally:
+                self.lock.release()
+            try:
+                self.poll()
+            except Exception, e:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+                for s in list(self.subscriptions):
+                    if s.errback:
+                        s.errback(e)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def subscribe(self, callback, errback=None):
+        """
+        Call callback(delta) whenever something changes, and errback(exception)
+        if a poll fails or the callback itself raises one.  New subscribers
+        first get a Delta with every current record 'added'.  Callbacks run in
+        the polling thread, so should be quick.
+        """
+        sub = Subscription(self, callback, errback)
+        self.lock.acquire()
+        try:
+            self.subscriptions.append(sub)
+            if self.hashes is not None:
+                callback(Delta(list(self.records.values()), [], [], list(self.records.values())))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="coda-watcher")
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        return sub
+
+    def unsubscribe(self, sub):
+        """Stop sending changes to a subscriber. Polling stops with the last one."""
+        self.lock.acquire()
+        try:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+            if not self.subscriptions:
+                self.wakeup.set()
+        finally:
+            self.lock.release()
+
+    def deltas(self, timeout=None):
+        """
+        A generator of Deltas, for those who'd rather loop than use callbacks.
+        Stops if no change arrives within 'timeout' seconds, or if a poll fails,
+        in which case the exception is raised.
+        """
+        q = Queue.Queue()
+        sub = self.subscribe(lambda d: q.put((d, None)), lambda e: q.put((None, e)))
+        try:
+            while True:
+                try:
+                    delta, error = q.get(True, timeout or 1e9)
+                except Queue.Empty:
+                    return
+                if error:
+                    raise error
+                yield delta
+        finally:
+            sub.cancel()
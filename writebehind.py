@@ -0,0 +1,140 @@
+#
+# A write-behind queue for calls which modify CODA objects.
+#
+# Several modifyDisplay calls for the same display in quick succession are
+# merged into one, so only the final state is sent to the server.  Calls are
+# sent in the background when enough have built up or the oldest has waited
+# long enough:
+#
+#     q = c.write_behind(max_delay=2.0)
+#     f = q.submit('modifyDisplay', display_uuid=du, tags=['lobby'])
+#     ...
+#     q.flush()        # eg. at shutdown
+#     f.result()       # the response, or raises CodaException
+#
+# This code is released under the GNU General Public License v2.
+# See COPYRIGHT.txt and LICENSE.txt.
+
+import threading
+from multiprocessing.pool import ThreadPool
+import api
+import pool
+
+try:
+    from collections import OrderedDict # Python 2.7 onwards
+except ImportError:
+    OrderedDict = dict
+
+# The calls which can be merged, and the parameter identifying their target
+MERGEABLE_METHODS = {
+    'modifyDisplay': 'display_uuid',
+    'modifySource':  'source_uuid',
+    'modifyUser':    'user_uuid',
+}
+
+class WriteBehindQueue(object):
+    def __init__(self, coda, max_pending=50, max_delay=2.0, workers=4):
+        """
+        coda        - the Coda object to send the calls with
+        max_pending - send once this many objects have changes waiting
+        max_delay   - send once the oldest change has waited this many seconds
+        workers     - number of calls to send at the same time
+        """
+        self.coda = coda
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.pool = ThreadPool(workers)
+        self.pending = OrderedDict()    # (method, uuid) -> (kwargs, [futures])
+        self.inflight = {}              # (method, uuid) -> [futures]
+        self.lock = threading.Lock()
+        self.sent = threading.Condition(self.lock)
+        self.timer = None
+
+    def submit(self, method, **kwargs):
+        """
+        Queue a call, merging it with any call still waiting for the same
+        object, and return a pool.Future for its response.
+        """
+        if method not in MERGEABLE_METHODS:
+            raise api.CodaException("Can't queue %s calls" % method)
+        key = (method, kwargs[MERGEABLE_METHODS[method]])
+        future = pool.Future()
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                params, futures = self.pending[key]
+                params.update(kwargs)
+                futures.append(future)
+            else:
+                self.pending[key] = (dict(kwargs), [future])
+            if len(self.pending) >= self.max_pending:
+                self._dispatch()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self._timeout)
+                self.timer.setDaemon(True)
+                self.timer.start()
+        finally:
+            self.lock.release()
+        return future
+
+    def _timeout(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+            self._dispatch()
+        finally:
+            self.lock.release()
+
+    def _dispatch(self):
+        """Start sending everything pending. Must be called with the lock held."""
+        for key in list(self.pending):
+            # Don't let a newer change overtake one for the same object
+            # which is still on its way.
+            if key in self.inflight:
+                continue
+            params, futures = self.pending.pop(key)
+            self.inflight[key] = futures
+            self.pool.apply_async(self._send, (key, params, futures))
+        if self.timer is not None and not self.pending:
+            self.timer.cancel()
+            self.timer = None
+
+    def _send(self, key, params, futures):
+        try:
+            try:
+                result = self.coda.callMethod(key[0], **params)
+            except Exception, e:
+                for f in futures:
+                    f.set_exception(e)
+            else:
+                for f in futures:
+                    f.set_result(result)
+        finally:
+            # Whatever happened, flush() and close() mustn't wait for this forever
+            self.lock.acquire()
+            try:
+                del self.inflight[key]
+                self.sent.notifyAll()
+                if key in self.pending and self.timer is None:
+                    self.timer = threading.Timer(self.max_delay, self._timeout)
+                    self.timer.setDaemon(True)
+                    self.timer.start()
+            finally:
+                self.lock.release()
+
+    def flush(self):
+        """Send everything now, and wait until it has all been sent"""
+        self.lock.acquire()
+        try:
+            self._dispatch()
+            while self.inflight or self.pending:
+                self.sent.wait()
+                self._dispatch()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Flush the queue and shut down its workers"""
+        self.flush()
+        self.pool.close()
+        self.pool.join()